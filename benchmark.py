@@ -0,0 +1,396 @@
+import os
+import io
+import re
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+import itertools
+import threading
+import subprocess
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from phantomfile import (FileSender, FileReceiver, TransferSettings, HASHES, COMPRESSIONS, CHUNK_SIZE,
+                         new_hash, endpoint, listen)
+
+SIZES = "1K,1M,64M,1G,10G"
+BASELINE_CHUNK = 1024
+# Stop-and-wait pays a round trip per KiB, bigger files only take longer.
+BASELINE_MAX_SIZE = 64 * 1024 * 1024
+TRANSPORTS = ["tcp"] + (["unix"] if hasattr(socket, "AF_UNIX") else [])
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STARTUP_PHASES = ["imports", "application", "window", "first_paint"]
+STARTUP_TIMEOUT = 30
+
+def hash_throughput(name, size=256 * 1024 * 1024, block=1024 * 1024):
+    data = memoryview(os.urandom(block))
+    hasher = new_hash(name)
+    start = time.perf_counter()
+    for _ in range(size // block):
+        hasher.update(data)
+    hasher.digest()
+    return size / (time.perf_counter() - start)
+
+def parse_size(text):
+    match = re.fullmatch(r"(\d+)\s*([KMG]?)i?B?", text.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError("Not a size: {}".format(text))
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+def parse_list(kind):
+    return lambda text: [kind(item) for item in text.split(",") if item]
+
+def make_file(path, size, data):
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return
+    # A sparse file costs no disk space and reads back as zeros from the page
+    # cache, so the transfer rather than the source disk is measured.
+    with open(path, "wb") as file:
+        if data == "sparse":
+            file.truncate(size)
+            return
+        block = 1024 * 1024
+        for offset in range(0, size, block):
+            file.write(os.urandom(min(block, size - offset)))
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# The transfer loop SenderThread and ReceiverThread used before the engine:
+# 1 KiB per send, and the sender waits for the receiver's progress reply
+# before reading the next chunk.
+def baseline_send(host, port, path):
+    family, address = endpoint(host, port)
+    client = socket.socket(family, socket.SOCK_STREAM)
+    client.connect(address)
+    client.send(os.path.basename(path).encode())
+    time.sleep(0.1)
+    client.send(str(os.path.getsize(path)).encode())
+    # The old code relied on timing to keep the size apart from the data, the
+    # pauses are left out of the measurement.
+    time.sleep(0.1)
+
+    start = time.perf_counter()
+    with open(path, "rb") as file:
+        chunk = file.read(BASELINE_CHUNK)
+        while chunk:
+            client.send(chunk)
+            client.recv(1024)
+            chunk = file.read(BASELINE_CHUNK)
+    client.close()
+    return start
+
+def baseline_receive(server, save_path):
+    client, _ = server.accept()
+    file_name = client.recv(1024).decode()
+    int(client.recv(1024).decode())
+
+    received = 0
+    with open(os.path.join(save_path, file_name), "wb") as file:
+        chunk = client.recv(BASELINE_CHUNK)
+        while chunk:
+            file.write(chunk)
+            received += len(chunk)
+            client.send(str(received).encode())
+            chunk = client.recv(BASELINE_CHUNK)
+    client.close()
+    return received
+
+def host_for(case, folder):
+    if case["transport"] == "unix":
+        return os.path.join(folder, "benchmark.sock"), 0
+    return "127.0.0.1", free_port()
+
+def transfer(case, path, save_path):
+    host, port = host_for(case, save_path)
+
+    if case["engine"] == "baseline":
+        server = listen(host, port, TransferSettings("custom", nodelay=False))
+        received = []
+        thread = threading.Thread(target=lambda: received.append(baseline_receive(server, save_path)))
+        thread.start()
+        start = baseline_send(host, port, path)
+        thread.join()
+        elapsed = time.perf_counter() - start
+        server.close()
+        return elapsed, received == [case["size"]]
+
+    def settings():
+        return TransferSettings("custom", chunk_size=case["chunk_kb"] * 1024, streams=case["streams"],
+                                hash_name=case["hash"], compression=case["compression"], pipeline=case.get("pipeline"))
+
+    receiver = FileReceiver(host, port, save_path, settings())
+    sender = FileSender(host, port, path, settings())
+    finished = []
+    receiver.on_finished = lambda: finished.append(True)
+
+    thread = threading.Thread(target=receiver.run)
+    thread.start()
+    # A refused connect would add the sender's two second retry to the result.
+    while receiver.server is None:
+        time.sleep(0.01)
+
+    start = time.perf_counter()
+    sender.run()
+    thread.join()
+    return time.perf_counter() - start, bool(finished)
+
+def io_syscalls():
+    # Only file reads and writes are counted here, socket send and recv calls
+    # show up in the strace totals.
+    try:
+        with open("/proc/self/io") as file:
+            fields = dict(line.split(": ") for line in file.read().splitlines())
+        return int(fields["syscr"]), int(fields["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def run_case(case, path):
+    save_path = tempfile.mkdtemp(prefix="phantomfile-bench-")
+    reads, writes = io_syscalls()
+    usage = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, ok = transfer(case, path, save_path)
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+    result = dict(case, ok=ok, seconds=elapsed, mb_per_s=case["size"] / elapsed / 1e6)
+    if reads is not None:
+        after = io_syscalls()
+        result.update(read_syscalls=after[0] - reads, write_syscalls=after[1] - writes)
+    if usage:
+        end = resource.getrusage(resource.RUSAGE_SELF)
+        result.update(cpu_user=end.ru_utime - usage.ru_utime, cpu_system=end.ru_stime - usage.ru_stime,
+                      context_switches=end.ru_nvcsw + end.ru_nivcsw - usage.ru_nvcsw - usage.ru_nivcsw,
+                      # kilobytes on Linux, bytes on macOS
+                      peak_rss=end.ru_maxrss)
+    return result
+
+def count_syscalls(command):
+    # Tracing slows the transfer down by an order of magnitude, so the count
+    # comes from a second run and never from the one that is timed.
+    with tempfile.NamedTemporaryFile("r", suffix=".strace") as output:
+        subprocess.run(["strace", "-f", "-c", "-o", output.name] + command,
+                       stdout=subprocess.DEVNULL, check=True)
+        for line in output.read().splitlines():
+            fields = line.split()
+            if fields and fields[-1] == "total":
+                return int(fields[3])
+    return None
+
+def spawn_case(case, path, strace):
+    # One process per case keeps the CPU time and peak RSS of the cases apart.
+    command = [sys.executable, os.path.abspath(__file__), "case", json.dumps(case), path]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, text=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    if strace:
+        result["syscalls"] = count_syscalls(command)
+    return result
+
+def cases(args):
+    for transport, size in itertools.product(args.transports, args.sizes):
+        base = {"transport": transport, "size": size}
+        if args.baseline and size <= BASELINE_MAX_SIZE:
+            yield dict(base, engine="baseline", chunk_kb=BASELINE_CHUNK // 1024, streams=1, hash="none", compression="none", pipeline=None)
+        for chunk_kb, streams, hash_name, compression, pipeline in itertools.product(args.chunk_kb, args.streams, args.hash, args.compress, args.pipeline):
+            yield dict(base, engine="phantomfile", chunk_kb=chunk_kb, streams=streams, hash=hash_name, compression=compression, pipeline=pipeline)
+
+def case_key(result):
+    return tuple(result.get(name) for name in ("engine", "transport", "size", "chunk_kb", "streams", "hash", "compression", "pipeline"))
+
+def compare(results, previous, tolerance):
+    earlier = {case_key(result): result for result in previous["results"]}
+    regressions = []
+    for result in results:
+        old = earlier.get(case_key(result))
+        if old and result["mb_per_s"] < old["mb_per_s"] * (1 - tolerance):
+            regressions.append((result, old))
+    return regressions
+
+def describe(result):
+    return "{engine:<11} {transport:<4} {size:>12} B  chunk {chunk_kb:>5} KiB  streams {streams}  {hash:<8} {compression:<5} pipeline {pipeline}".format(**result)
+
+def run_transfers(args):
+    os.makedirs(args.dir, exist_ok=True)
+    strace = args.strace and shutil.which("strace")
+    if args.strace and not strace:
+        print("strace not found, total syscall counts are left out", file=sys.stderr)
+
+    results = []
+    for case in cases(args):
+        path = os.path.join(args.dir, "phantomfile-bench-{}-{}".format(args.data, case["size"]))
+        if shutil.disk_usage(args.dir).free < case["size"] * 2:
+            print("skipped, not enough disk space: " + describe(case), file=sys.stderr)
+            continue
+        make_file(path, case["size"], args.data)
+        result = spawn_case(case, path, strace)
+        result["data"] = args.data
+        results.append(result)
+        print("{}  {:>9.1f} MB/s{}".format(describe(result), result["mb_per_s"], "" if result["ok"] else "  FAILED"), file=sys.stderr)
+        if not args.keep:
+            os.remove(path)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if not args.compare:
+        return 0 if all(result["ok"] for result in results) else 1
+    with open(args.compare) as file:
+        regressions = compare(results, json.load(file), args.tolerance)
+    for result, old in regressions:
+        print("regression: {}  {:.1f} -> {:.1f} MB/s".format(describe(result), old["mb_per_s"], result["mb_per_s"]), file=sys.stderr)
+    return 1 if regressions else 0
+
+def main_source(revision):
+    if not revision:
+        with open(os.path.join(ROOT, "main.py")) as file:
+            return file.read()
+    return subprocess.run(["git", "show", revision + ":main.py"], cwd=ROOT, stdout=subprocess.PIPE,
+                          check=True, text=True).stdout
+
+def startup_case(revision, spawned):
+    # Loads main.py as of the revision in this fresh process, builds the
+    # window and waits for its first paint. Every phase is counted from the
+    # moment the parent spawned the process, interpreter start included.
+    source = main_source(revision)
+    module = type(sys)("phantom_main")
+    module.__file__ = os.path.join(ROOT, "main.py")
+    exec(compile(source, module.__file__, "exec"), module.__dict__)
+    timings = {"imports": time.time() - spawned}
+
+    from PySide6.QtCore import QObject, QEvent, QTimer
+    from PySide6.QtWidgets import QApplication
+
+    app = QApplication([])
+    timings["application"] = time.time() - spawned
+    window = module.MainWindow(app)
+    timings["window"] = time.time() - spawned
+
+    class FirstPaint(QObject):
+        def eventFilter(self, watched, event):
+            if event.type() == QEvent.Paint and "first_paint" not in timings:
+                timings["first_paint"] = time.time() - spawned
+                QTimer.singleShot(0, app.quit)
+            return False
+
+    watcher = FirstPaint()
+    window.installEventFilter(watcher)
+    window.show()
+    QTimer.singleShot(STARTUP_TIMEOUT * 1000, app.quit)
+    app.exec()
+    return timings
+
+def run_startup(args):
+    # Cold starts only, each run is a new interpreter. The working tree is
+    # measured when no revision is given, so "HEAD~1," compares a change
+    # against its parent.
+    results = []
+    for revision in args.revisions:
+        runs = []
+        for _ in range(args.runs):
+            command = [sys.executable, os.path.abspath(__file__), "startup-case", revision, repr(time.time())]
+            output = subprocess.run(command, cwd=ROOT, stdout=subprocess.PIPE, check=True, text=True).stdout
+            runs.append(json.loads(output.splitlines()[-1]))
+        result = {"revision": revision or "working tree", "runs": runs}
+        for phase in STARTUP_PHASES:
+            values = [run[phase] for run in runs if phase in run]
+            result[phase] = statistics.median(values) if values else None
+        results.append(result)
+        print("{:<16} ".format(result["revision"]) + "  ".join(
+            "{} {}".format(phase, "--" if result[phase] is None else "{:.0f} ms".format(result[phase] * 1000))
+            for phase in STARTUP_PHASES), file=sys.stderr)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark hashes and transfers between two local endpoints.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("hash", help="hash throughput (the default)")
+
+    transfers = commands.add_parser("transfer", help="sweep transfer settings over loopback and Unix sockets")
+    transfers.add_argument("--sizes", type=parse_list(parse_size), default=parse_list(parse_size)(SIZES))
+    transfers.add_argument("--chunk-kb", type=parse_list(int), default=[CHUNK_SIZE // 1024])
+    transfers.add_argument("--streams", type=parse_list(int), default=[1])
+    transfers.add_argument("--hash", type=parse_list(str), default=["none"], help=",".join(HASHES))
+    transfers.add_argument("--compress", type=parse_list(str), default=["none"], help=",".join(COMPRESSIONS))
+    transfers.add_argument("--pipeline", type=parse_list(int), default=[None], help="disk queue depths, the engine default if left out")
+    transfers.add_argument("--transports", type=parse_list(str), default=TRANSPORTS)
+    transfers.add_argument("--data", choices=["sparse", "random"], default="sparse")
+    transfers.add_argument("--dir", default=tempfile.gettempdir(), help="where the source files are created")
+    transfers.add_argument("--keep", action="store_true", help="keep the source files for the next run")
+    transfers.add_argument("--no-baseline", dest="baseline", action="store_false",
+                           help="skip the old 1 KiB stop-and-wait transfer")
+    transfers.add_argument("--strace", action="store_true", help="count every syscall with a second, traced run")
+    transfers.add_argument("--output", help="write the JSON report here instead of stdout")
+    transfers.add_argument("--compare", help="earlier report, exit with 1 when a case got slower")
+    transfers.add_argument("--tolerance", type=float, default=0.1, help="slowdown allowed by --compare")
+
+    startup = commands.add_parser("startup", help="time the GUI from a cold start to its first paint")
+    startup.add_argument("revisions", nargs="?", type=lambda text: text.split(","), default=[""],
+                         help="git revisions of main.py, an empty entry for the working tree")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--output", help="write the JSON report here instead of stdout")
+
+    # One benchmark case in a fresh process, used by the transfer sweep.
+    case = commands.add_parser("case")
+    case.add_argument("case", type=json.loads)
+    case.add_argument("path")
+
+    # One cold start in a fresh process, used by the startup report.
+    startup_run = commands.add_parser("startup-case")
+    startup_run.add_argument("revision")
+    startup_run.add_argument("spawned", type=float)
+
+    args = parser.parse_args(argv)
+    if args.command == "case":
+        print(json.dumps(run_case(args.case, args.path)))
+        return 0
+    if args.command == "startup-case":
+        print(json.dumps(startup_case(args.revision, args.spawned)))
+        return 0
+    if args.command == "transfer":
+        return run_transfers(args)
+    if args.command == "startup":
+        return run_startup(args)
+
+    # A hash slower than the link becomes the bottleneck of the transfer.
+    for name in HASHES[1:]:
+        print("{:<10} {:>10.1f} MB/s".format(name, hash_throughput(name) / 1e6))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,24 @@
 import os
 import sys
-import cv2
-import tqdm
 import time
-import socket
+import hashlib
+import threading
+import contextlib
+import concurrent.futures
 
 from PySide6.QtWidgets import (QApplication, QWidget, QLabel, QPushButton, 
                                QVBoxLayout, QHBoxLayout, QTextEdit, QStackedLayout,
                                QFileDialog, QFileDialog, QFileIconProvider, 
                                QSizePolicy, QGraphicsView, QGraphicsScene, 
                                QGraphicsPixmapItem, QProgressBar, QSpacerItem, 
-                               QDialog)
-from PySide6.QtGui import QIcon, QPixmap, QPainter, QImage, QMouseEvent, QTransform, QMovie, QIcon, QDesktopServices
-from PySide6.QtCore import Qt, QFileInfo, QThread, Signal, QPoint, QTimer, QSize, QUrl
+                               QDialog, QComboBox, QCheckBox, QListWidget,
+                               QListWidgetItem, QToolTip)
+from PySide6.QtGui import (QIcon, QPixmap, QImage, QMouseEvent, QTransform, QMovie, QIcon, QDesktopServices,
+                           QImageReader, QImageIOHandler)
+from PySide6.QtCore import Qt, QFileInfo, QObject, Signal, QPoint, QTimer, QSize, QRect, QUrl, QStandardPaths
+
+from phantomfile import TransferSettings, Batch, Progress, PROFILES, HASHES, COMPRESSIONS, CHUNK_SIZE, MAX_TRANSFERS, new_hash
+from phantomasync import EventLoopThread, AsyncFileSender, AsyncFileReceiver, AsyncReceiverServer
 
 class RotatingImage(QGraphicsView):
     steps = 1
@@ -64,8 +70,11 @@ class Progressbar_Widget(QWidget):
         self.maximum_data = QLabel("0 B")
         self.percentage = QLabel("0 %")
         self.rate = QLabel("0")
+        self.file_status = QLabel("")
+        self.rate_details = QLabel("")
         self.progressbar = QProgressBar()
         self.file_size = 0
+        self.batch = None
 
         self.percentage.setAlignment(Qt.AlignLeft)
         self.percentage.setStyleSheet(
@@ -115,6 +124,31 @@ class Progressbar_Widget(QWidget):
             """
         )
 
+        self.file_status.setAlignment(Qt.AlignLeft)
+        self.file_status.hide()
+        self.file_status.setStyleSheet(
+            """
+                QLabel
+                {
+                    color: #A0A0A0;
+                    font-size: 12px;
+                    font-weight: 500;
+                }
+            """
+        )
+
+        self.rate_details.setAlignment(Qt.AlignRight)
+        self.rate_details.setStyleSheet(
+            """
+                QLabel
+                {
+                    color: #A0A0A0;
+                    font-size: 12px;
+                    font-weight: 500;
+                }
+            """
+        )
+
         self.progressbar.setFixedHeight(20)
         self.progressbar.setRange(0, 100)
         self.progressbar.setValue(0)
@@ -149,15 +183,24 @@ class Progressbar_Widget(QWidget):
         text_layout.addSpacing(5)
 
         rate_layout = QHBoxLayout()
+        rate_layout.addSpacing(5)
+        rate_layout.addWidget(self.file_status)
+        rate_layout.setAlignment(self.file_status, Qt.AlignLeft | Qt.AlignVCenter)
         rate_layout.addWidget(self.rate)
         rate_layout.setAlignment(self.rate, Qt.AlignRight | Qt.AlignVCenter)
         rate_layout.addSpacing(5)
 
+        details_layout = QHBoxLayout()
+        details_layout.addWidget(self.rate_details)
+        details_layout.setAlignment(self.rate_details, Qt.AlignRight | Qt.AlignVCenter)
+        details_layout.addSpacing(5)
+
         progressbar_layout = QVBoxLayout()
         progressbar_layout.setAlignment(Qt.AlignCenter)
         progressbar_layout.addLayout(text_layout)
         progressbar_layout.addWidget(self.progressbar)
         progressbar_layout.addLayout(rate_layout)
+        progressbar_layout.addLayout(details_layout)
 
         self.setLayout(progressbar_layout)
 
@@ -211,10 +254,23 @@ class Progressbar_Widget(QWidget):
         file_size = self.format_file_size(value)
         self.maximum_data.setText(file_size)
 
+    def set_batch(self, batch):
+        # Batches get a second line with the file the progress has reached.
+        self.batch = batch if batch is not None and len(batch.members) > 1 else None
+        self.file_status.setVisible(self.batch is not None)
+
     def set_current_data(self, value):
         file_size = self.format_file_size(value)
         self.current_data.setText(file_size)
 
+        if self.batch is not None:
+            index = self.batch.locate(min(value, self.batch.size - 1))
+            member = self.batch.members[index]
+            done = min(member.size, value - self.batch.starts[index])
+            percentage = round(done / member.size * 100) if member.size else 100
+            name = os.path.basename(member.name)
+            self.file_status.setText(f"{index + 1}/{len(self.batch.members)}  {name}  {percentage} %")
+
         if self.file_size:
             percentage = (value / self.file_size) * 100
             percentage = round(percentage, 2)
@@ -224,6 +280,13 @@ class Progressbar_Widget(QWidget):
         transfer_rate = self.format_transfer_rate(rate)
         self.rate.setText(transfer_rate)
 
+    def set_rates(self, meter):
+        self.set_transfer_rate(meter.current())
+        average = self.format_transfer_rate(meter.average())
+        peak = self.format_transfer_rate(meter.peak)
+        eta = self.format_duration(meter.eta(self.file_size))
+        self.rate_details.setText(f"avg {average}   peak {peak}   ETA {eta}")
+
     @staticmethod
     def format_file_size(size):
         units = ['B', 'KB', 'MB', 'GB', 'TB']
@@ -233,6 +296,14 @@ class Progressbar_Widget(QWidget):
             index += 1
         return f"{size:.2f} {units[index]}"
     
+    @staticmethod
+    def format_duration(seconds):
+        if seconds is None:
+            return "--:--"
+        minutes, seconds = divmod(round(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
     @staticmethod
     def format_transfer_rate(rate):
         units = ['B/s', 'KB/s', 'MB/s', 'GB/s', 'TB/s']
@@ -547,151 +618,362 @@ class AboutMeDialog(QDialog):
     def open_website(self):
         QDesktopServices.openUrl(QUrl("https://jewelvjohn.github.io/"))
 
-class SenderThread(QThread):
+# The tasks leave their progress in a Progress counter that the window
+# samples on a timer, instead of queueing a signal per acknowledgement.
+def raised(future):
+    # An engine that dies on an unexpected error never reports it itself,
+    # its future is the only place the error shows up.
+    if future.cancelled() or future.exception() is None:
+        return False
+    print("Transfer task failed:", repr(future.exception()))
+    return True
+
+class SenderTask(QObject):
     connectionEstablished = Signal()
-    progressChanged = Signal(int)
     transferFailed = Signal()
     fileRecieved = Signal()
 
-    def __init__(self, host: str, port: int, file_path: str):
+    def __init__(self, loop: EventLoopThread, host: str, port: int, file_path, settings: TransferSettings):
         super().__init__()
 
-        self.host = host
-        self.port = port
-        self.file_path = file_path
-        self.stop_request = False
+        self.loop = loop
+        self.sender = AsyncFileSender(host, port, file_path, settings)
+        self.sender.on_connected = self.connectionEstablished.emit
+        self.counter = Progress()
+        self.sender.on_progress = self.counter.update
+        self.sender.on_failed = self.transferFailed.emit
+        self.sender.on_finished = self.fileRecieved.emit
 
-    def stop(self):
-        self.stop_request = True
+    @property
+    def batch(self):
+        return self.sender.batch
 
-    def run(self):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    @property
+    def meter(self):
+        return self.sender.meter
 
-        while True:
-            if self.stop_request:
-                return
-            try:
-                client.connect((self.host, self.port))
-                break
-            except ConnectionRefusedError:
-                print("Connection refused. Retrying in 2 seconds...")
-                time.sleep(2)
+    def stop(self):
+        self.sender.stop()
 
-        file_name = os.path.basename(self.file_path)
-        file_size = os.path.getsize(self.file_path)
+    def start(self):
+        self.loop.submit(self.sender.run()).add_done_callback(self.finished)
 
-        client.send(file_name.encode())
-        time.sleep(0.1)
-        client.send(str(file_size).encode())
+    def finished(self, future):
+        if raised(future):
+            self.transferFailed.emit()
 
-        self.connectionEstablished.emit()
+class ReceiverTask(QObject):
+    connectionEstablished = Signal(str)
+    transferFailed = Signal()
+    fileRecieved = Signal()
+    fileSize = Signal("qint64")
 
-        with open(self.file_path, 'rb') as file:
-            chunk = file.read(1024)
-            
-            while chunk and not self.stop_request:
-                client.send(chunk)
-                progress = int(client.recv(1024).decode())
+    def __init__(self, loop: EventLoopThread, host: str, port: int, file_path: str, settings: TransferSettings):
+        super().__init__()
 
-                if progress == -99:
-                    self.transferFailed.emit()
-                    client.close()
-                    return
+        self.loop = loop
+        self.receiver = AsyncFileReceiver(host, port, file_path, settings)
+        self.receiver.on_connected = self.connection_established
+        self.receiver.on_progress = self.progress_changed
+        self.receiver.on_failed = self.transferFailed.emit
+        self.receiver.on_finished = self.fileRecieved.emit
+        self.counter = Progress()
+        self.progress = None
 
-                self.progressChanged.emit(progress)
-                chunk = file.read(1024)
+    @property
+    def batch(self):
+        return self.receiver.batch
 
-        if not self.stop_request:
-            self.fileRecieved.emit()
-            print("File Transfer Successfully.")
-        else:
-            client.send("<#END PROCESS#>".encode())
-            print("File Transfer Failed")
+    @property
+    def meter(self):
+        return self.receiver.meter
 
-        client.close()
+    def stop(self):
+        self.receiver.stop()
 
-class ReceiverThread(QThread):
-    connectionEstablished = Signal(str)
-    progressChanged = Signal(int)
-    transferFailed = Signal()
-    fileRecieved = Signal()
-    fileSize = Signal(int)
+    def connection_established(self, file_name, file_size):
+        import tqdm
 
-    stop_request = False
-    connected = False
+        self.progress = tqdm.tqdm(unit="B", unit_scale=True, unit_divisor=1000, total=file_size)
+        self.connectionEstablished.emit(file_name)
+        self.fileSize.emit(file_size)
 
-    def __init__(self, host: str, port: int, file_path: str):
-        super().__init__()
-        self.host = host
-        self.port = port
-        self.file_path = file_path
+    def progress_changed(self, received):
+        self.progress.update(received - self.progress.n)
+        self.counter.update(received)
 
-    def stop(self):
-        self.stop_request = True
+    def start(self):
+        self.loop.submit(self.receiver.run()).add_done_callback(self.finished)
 
-    def run(self):
-        os.makedirs(self.file_path, exist_ok=True)
+    def finished(self, future):
+        if self.progress is not None:
+            self.progress.close()
+        if raised(future):
+            self.transferFailed.emit()
 
-        stop_message = "<#END PROCESS#>".encode()
+class ServerTask(QObject):
+    transferStarted = Signal(int, str, "qint64")
+    transferFailed = Signal(int)
+    fileRecieved = Signal(int)
+    serverFailed = Signal(str)
 
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind((self.host, self.port))
-        server.listen()
+    def __init__(self, loop: EventLoopThread, host: str, port: int, file_path: str, settings: TransferSettings, limit: int):
+        super().__init__()
 
-        print("Server listening on {}:{}".format(self.host, self.port))
-        client, client_addr = server.accept()
+        self.loop = loop
+        self.server = AsyncReceiverServer(host, port, file_path, settings, limit)
+        self.server.on_started = self.transfer_started
+        self.server.on_progress = self.progress_changed
+        self.server.on_failed = self.transferFailed.emit
+        self.server.on_finished = self.fileRecieved.emit
+        self.server.on_error = lambda error: self.serverFailed.emit(str(error))
+        self.counters = {}
 
-        self.connected = True
-        print("Client connected: ", client_addr)
+    def stop(self):
+        self.server.stop()
+
+    def transfer_started(self, number, file_name, file_size):
+        self.counters[number] = Progress()
+        self.transferStarted.emit(number, file_name, file_size)
+
+    def progress_changed(self, number, completed):
+        self.counters[number].update(completed)
+
+    def start(self):
+        self.loop.submit(self.server.run()).add_done_callback(self.finished)
+
+    def finished(self, future):
+        if raised(future):
+            self.serverFailed.emit(str(future.exception()))
+
+def square_thumbnail(image: QImage, size: int):
+    # Center square of the image, scaled down to size.
+    side = min(image.width(), image.height())
+    image = image.copy((image.width() - side) // 2, (image.height() - side) // 2, side, side)
+    return image.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio, Qt.SmoothTransformation)
+
+def image_thumbnail(file_path, size, cancelled, max_pixels=16 * 1024 * 1024):
+    # The decoder is asked for the thumbnail itself. JPEG scales down while
+    # it decodes and the clip keeps only the center square, so memory stays
+    # in the order of the thumbnail however large the source is. Formats
+    # that can only decode in full are skipped past max_pixels, and so are
+    # files whose header gives no size to check, the file icon stays up
+    # for them.
+    reader = QImageReader(file_path)
+    reader.setAutoTransform(True)
+    source = reader.size()
+    if not source.isValid():
+        return None
+
+    width, height = source.width(), source.height()
+    if width * height > max_pixels and not reader.supportsOption(QImageIOHandler.ImageOption.ScaledSize):
+        return None
+    side = min(width, height)
+    if side > size:
+        scaled_width = max(size, round(width * size / side))
+        scaled_height = max(size, round(height * size / side))
+        reader.setScaledSize(QSize(scaled_width, scaled_height))
+        reader.setScaledClipRect(QRect((scaled_width - size) // 2, (scaled_height - size) // 2, size, size))
+    else:
+        reader.setClipRect(QRect((width - side) // 2, (height - side) // 2, side, side))
+    if cancelled():
+        return None
+
+    image = reader.read()
+    if image.isNull() or cancelled():
+        return None
+    return image.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio, Qt.SmoothTransformation)
+
+def open_video(cv2, file_path, timeout):
+    # The FFmpeg backend gives up on opening and on every read after timeout
+    # seconds, older OpenCV builds without the options wait for as long as
+    # it takes.
+    if not hasattr(cv2, "CAP_PROP_OPEN_TIMEOUT_MSEC"):
+        return cv2.VideoCapture(file_path)
+    milliseconds = max(1, int(timeout * 1000))
+    return cv2.VideoCapture(file_path, cv2.CAP_ANY, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, milliseconds,
+                                                     cv2.CAP_PROP_READ_TIMEOUT_MSEC, milliseconds])
+
+def video_frame(cv2, file_path, cancelled, deadline, first_frames=10):
+    # A quarter in, found by timestamp: the demuxer jumps to the keyframe
+    # before it and only that group of pictures is decoded, whatever the
+    # length of the video. The frame count of many containers is missing
+    # or wrong, so the duration is only trusted when it is positive and
+    # the first decodable frame is the fallback.
+    cap = open_video(cv2, file_path, deadline - time.monotonic())
+    try:
+        if not cap.isOpened():
+            return None
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        if fps > 0 and frame_count > 0 and time.monotonic() < deadline and not cancelled():
+            cap.set(cv2.CAP_PROP_POS_MSEC, frame_count / fps * 1000 / 4)
+            ok, frame = cap.read()
+            if ok and frame is not None:
+                return frame
+    finally:
+        cap.release()
 
-        file_name = client.recv(1024).decode()
-        file_size = int(client.recv(1024).decode())
+    # A failed seek can leave the decoder anywhere, the fallback starts over.
+    if time.monotonic() >= deadline or cancelled():
+        return None
+    cap = open_video(cv2, file_path, deadline - time.monotonic())
+    try:
+        for _ in range(first_frames):
+            ok, frame = cap.read()
+            if ok and frame is not None:
+                return frame
+            if time.monotonic() >= deadline or cancelled():
+                return None
+    finally:
+        cap.release()
+    return None
+
+def video_thumbnail(file_path, size, cancelled, budget=0.5):
+    # OpenCV takes longer to import than the window takes to build, so it
+    # is only loaded for the first video preview. The budget covers the
+    # opening, seeking and decoding, the file icon stays up past it.
+    import cv2
+
+    frame = video_frame(cv2, file_path, cancelled, time.monotonic() + budget)
+    if frame is None or cancelled():
+        return None
+
+    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    height, width, channel = rgb_frame.shape
+    # The QImage only wraps the array, the copy outlives it.
+    image = QImage(rgb_frame.data, width, height, channel * width, QImage.Format_RGB888).copy()
+    return square_thumbnail(image, size)
+
+class ThumbnailCache:
+    # Rendered thumbnails kept as PNG files named after their key. The key
+    # covers the path, size and mtime of the source, or with a hash_name its
+    # content, so copies of the same media share an entry at the cost of
+    # reading the file. Entries are touched when used and the least recently
+    # used go once the folder grows past max_bytes. Workers share it.
+    def __init__(self, folder, max_bytes=64 * 1024 * 1024, hash_name=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hash_name = hash_name
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def key(self, file_path, size):
+        stat = os.stat(file_path)
+        if self.hash_name:
+            hasher = new_hash(self.hash_name)
+            with open(file_path, 'rb') as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    hasher.update(block)
+            identity = (self.hash_name, hasher.digest().hex(), stat.st_size, size)
+        else:
+            identity = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, size)
+        return hashlib.sha256(repr(identity).encode()).hexdigest() + ".png"
+
+    def load_entries(self):
+        # Last use and size of every entry, read from the folder once.
+        if self.entries is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self.entries = {}
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith(".png"):
+                    stat = entry.stat()
+                    self.entries[entry.name] = (stat.st_mtime, stat.st_size)
+        return self.entries
+
+    def get(self, key):
+        path = os.path.join(self.folder, key)
+        image = QImage(path)
+        if image.isNull():
+            return None
+        now = time.time()
+        with contextlib.suppress(OSError):
+            os.utime(path, (now, now))
+        with self.lock:
+            entries = self.load_entries()
+            if key in entries:
+                entries[key] = (now, entries[key][1])
+        return image
+
+    def put(self, key, image):
+        path = os.path.join(self.folder, key)
+        with self.lock:
+            self.load_entries()
+        # Written aside and renamed, a reader never sees half a file.
+        temporary = "{}.{}.tmp".format(path, threading.get_ident())
+        if not image.save(temporary, "PNG"):
+            return
+        os.replace(temporary, path)
+        with self.lock:
+            self.entries[key] = (time.time(), os.path.getsize(path))
+            self.evict()
+
+    def evict(self):
+        total = sum(size for _, size in self.entries.values())
+        for key, (_, size) in sorted(self.entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.folder, key))
+            del self.entries[key]
+            total -= size
+
+class ThumbnailTask(QObject):
+    # Renders previews on a small pool so decoding a 4K video or a huge image
+    # never blocks the window. Every request gets a number and a newer one
+    # cancels the older: a queued render is dropped, a running one checks
+    # between steps and its result is thrown away. QPixmap is GUI thread
+    # only, the workers hand over a QImage.
+    thumbnailReady = Signal(int, QImage)
+    workers = 2
+
+    def __init__(self, size: int, cache: ThumbnailCache = None):
+        super().__init__()
 
-        self.connectionEstablished.emit(file_name)
-        self.fileSize.emit(file_size)
+        self.size = size
+        self.cache = cache
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="thumbnail")
+        self.number = 0
+        self.future = None
 
-        (tm_year, tm_mon, tm_mday, tm_hour, tm_min, tm_sec, _, _, _) = time.localtime()
-        name_mark = "PF ["+ str(tm_mday) +"-"+ str(tm_mon) +"-"+ str(tm_year) +"]" + "["+ str(tm_hour) +"-"+ str(tm_min) +"-"+ str(tm_sec) +"] "
-
-        file_name = name_mark + file_name
-        self.file_path = self.file_path + "/" + file_name
-
-        progress = tqdm.tqdm(unit="B", unit_scale=True, unit_divisor=1000, total=file_size)
-
-        with open(self.file_path, 'wb') as file:
-            chunk = client.recv(1024)
-            
-            while chunk and not self.stop_request:
-                file.write(chunk)
-                client.send(str(progress.n).encode())
-                progress.update(1024)
-                self.data_transfered = progress.n
-                self.progressChanged.emit(self.data_transfered)
-
-                chunk = client.recv(1024)
-                if chunk == stop_message:
-                    file.close()
-                    os.remove(self.file_path)
-                    self.transferFailed.emit()
-                    client.close()
-                    server.close()
-                    return
-        
-        if not self.stop_request:
-            self.fileRecieved.emit()
-            print("File received successfully.")
+    def request(self, file_path, render):
+        self.cancel()
+        number = self.number
+        self.future = self.pool.submit(self.render, number, file_path, render)
+        return number
 
-        else:
-            os.remove(self.file_path)
-            client.send("-99".encode())
-            print("Failed to receive file")
+    def cancel(self):
+        self.number += 1
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
 
-        client.close()
-        server.close()
+    def stop(self):
+        self.cancel()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def render(self, number, file_path, render):
+        cancelled = lambda: number != self.number
+        try:
+            key = self.cache.key(file_path, self.size) if self.cache is not None else None
+            image = self.cache.get(key) if key is not None else None
+            if image is None:
+                image = render(file_path, self.size, cancelled)
+                # Kept even when cancelled, the work is done either way.
+                if image is not None and key is not None:
+                    self.cache.put(key, image)
+        except Exception as error:
+            print("Preview failed:", error)
+            return
+        if image is not None and not cancelled():
+            self.thumbnailReady.emit(number, image)
 
 class MainWindow(QWidget):
     save_path = str()
-    sending_file_path = str()
+    sending_paths = list()
+    profiles = ["auto", "loopback", "lan", "wan", "custom"]
+    default_tuning = ["auto", str(CHUNK_SIZE // 1024), "0", "1", "0", "none", "auto", str(MAX_TRANSFERS)]
+    progress_interval = 1000 // 30
 
     def __init__(self, app):
         super().__init__()
@@ -707,6 +989,15 @@ class MainWindow(QWidget):
         self.dragging = False
         self.draggable = True
 
+        # Every transfer of the window is a task on this one loop.
+        self.transfer_loop = EventLoopThread()
+        self.transfer_loop.start()
+
+        cache_path = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.GenericCacheLocation)
+        self.thumbnails = ThumbnailTask(128, ThumbnailCache(os.path.join(cache_path, "phantomfile", "thumbnails")))
+        self.thumbnails.thumbnailReady.connect(self.thumbnail_ready)
+
+        self.initialize_timers()
         self.initialize_ui()
         self.initialize_settings()
 
@@ -723,6 +1014,10 @@ class MainWindow(QWidget):
         if event.button() == Qt.LeftButton and self.dragging:
             self.dragging = False
 
+    def closeEvent(self, event):
+        self.thumbnails.stop()
+        super().closeEvent(event)
+
     def initialize_settings(self):
         self.settings_path = "files/settings.jwl"
         if(os.path.isfile(self.settings_path)):
@@ -745,7 +1040,7 @@ class MainWindow(QWidget):
         self.port = 9999
         self.save_path = saves
 
-        data = f"{self.host},{self.port},{self.save_path}"
+        data = ",".join([self.host, str(self.port), self.save_path] + self.default_tuning)
 
         with open(self.settings_path, "w") as file:
             file.write(data)
@@ -753,10 +1048,27 @@ class MainWindow(QWidget):
 
     def update_settings(self):
         ip_addr = self.host_textbox.toPlainText()
-        port = int(self.port_textbox.toPlainText())
         save_path = self.saves_textbox.toPlainText()
-
-        data = f"{ip_addr},{port},{save_path}"
+        profile = self.profile_combobox.currentText()
+        nodelay = int(self.nodelay_checkbox.isChecked())
+        hash_name = self.hash_combobox.currentText()
+        compression = self.compression_combobox.currentText()
+        try:
+            port = int(self.port_textbox.toPlainText())
+            chunk_size = int(self.chunk_textbox.toPlainText())
+            socket_buffer = int(self.buffer_textbox.toPlainText())
+            streams = int(self.streams_textbox.toPlainText())
+            clients = int(self.clients_textbox.toPlainText())
+            if clients < 1:
+                raise ValueError("At least one client has to be allowed")
+            # The custom profile takes the values as typed, nothing is saved
+            # unless the engine would accept them.
+            TransferSettings(profile, chunk_size * 1024, socket_buffer * 1024, nodelay, streams)
+        except ValueError as error:
+            QToolTip.showText(self.chunk_textbox.mapToGlobal(QPoint(0, 0)), str(error), self.chunk_textbox)
+            return
+
+        data = f"{ip_addr},{port},{save_path},{profile},{chunk_size},{socket_buffer},{nodelay},{streams},{hash_name},{compression},{clients}"
 
         with open(self.settings_path, "w") as file:
             file.write(data)
@@ -766,16 +1078,75 @@ class MainWindow(QWidget):
     def refresh_settings(self):
         with open(self.settings_path, 'r') as file:
             data = file.read()
-            addr, port, saves = data.split(",")
+            addr, port, saves, *tuning = data.split(",")
+            profile, chunk_size, socket_buffer, nodelay, streams, hash_name, compression, clients = tuning + self.default_tuning[len(tuning):]
             os.makedirs(saves, exist_ok=True)
 
             self.host = addr
             self.port = int(port)
             self.save_path = saves
+            self.profile = profile
+            self.chunk_size = int(chunk_size) * 1024
+            self.socket_buffer = int(socket_buffer) * 1024
+            self.nodelay = bool(int(nodelay))
+            self.streams = int(streams)
+            self.hash_name = hash_name
+            self.compression = compression
+            self.clients = int(clients)
+
+        if "settings" in self.pages:
+            self.fill_settings()
+
+    def fill_settings(self):
+        self.host_textbox.setPlainText(self.host)
+        self.port_textbox.setPlainText(str(self.port))
+        self.saves_textbox.setPlainText(self.save_path)
+        self.profile_combobox.setCurrentText(self.profile)
+        self.chunk_textbox.setPlainText(str(self.chunk_size // 1024))
+        self.buffer_textbox.setPlainText(str(self.socket_buffer // 1024))
+        self.nodelay_checkbox.setChecked(self.nodelay)
+        self.streams_textbox.setPlainText(str(self.streams))
+        self.hash_combobox.setCurrentText(self.hash_name)
+        self.compression_combobox.setCurrentText(self.compression)
+        self.clients_textbox.setPlainText(str(self.clients))
+        self.profile_changed(self.profile)
+
+    def transfer_settings(self):
+        return TransferSettings(self.profile, self.chunk_size, self.socket_buffer, self.nodelay, self.streams, self.hash_name, self.compression)
+
+    def profile_changed(self, profile):
+        if profile in PROFILES:
+            chunk_size, socket_buffer, nodelay, streams = PROFILES[profile]
+            self.chunk_textbox.setPlainText(str(chunk_size // 1024))
+            self.buffer_textbox.setPlainText(str(socket_buffer // 1024))
+            self.nodelay_checkbox.setChecked(nodelay)
+            self.streams_textbox.setPlainText(str(streams))
+
+        editable = profile == "custom"
+        self.chunk_textbox.setReadOnly(not editable)
+        self.buffer_textbox.setReadOnly(not editable)
+        self.streams_textbox.setReadOnly(not editable)
+        self.nodelay_checkbox.setEnabled(editable)
+
+    def initialize_timers(self):
+        # Progress is polled at 30 Hz, the rate labels are refreshed every 200 ms.
+        self.sender_progress_timer = QTimer()
+        self.sender_progress_timer.setInterval(self.progress_interval)
+        self.sender_progress_timer.timeout.connect(self.sender_progress_update)
+        self.sender_timer = QTimer()
+        self.sender_timer.setInterval(200)
+        self.sender_timer.timeout.connect(self.sender_rate_update)
+
+        self.receiver_progress_timer = QTimer()
+        self.receiver_progress_timer.setInterval(self.progress_interval)
+        self.receiver_progress_timer.timeout.connect(self.receiver_progress_update)
+        self.receiver_timer = QTimer()
+        self.receiver_timer.setInterval(200)
+        self.receiver_timer.timeout.connect(self.receiver_rate_update)
 
-            self.host_textbox.setPlainText(self.host)
-            self.port_textbox.setPlainText(str(self.port))
-            self.saves_textbox.setPlainText(self.save_path)
+        self.server_progress_timer = QTimer()
+        self.server_progress_timer.setInterval(self.progress_interval)
+        self.server_progress_timer.timeout.connect(self.server_progress_update)
 
     def initialize_ui(self):
         self.setStyleSheet(
@@ -790,23 +1161,19 @@ class MainWindow(QWidget):
         titlebar = self.titlebar_ui()
         self.draggable_area = titlebar.rect()
 
+        # Only the main page is built before the window shows, the others
+        # along with their icons and animations the first time they are opened.
+        self.page_builders = {
+            "main": self.main_ui,
+            "settings": self.settings_ui,
+            "sender": self.sender_ui,
+            "sending": self.sending_ui,
+            "receiver": self.receiver_ui,
+            "server": self.server_ui,
+        }
+        self.pages = {}
         self.stacked_layout = QStackedLayout()
-
-        intro_widget = self.main_ui()
-        self.stacked_layout.addWidget(intro_widget)
-
-        settings_widget = self.settings_ui()
-        self.stacked_layout.addWidget(settings_widget)
-
-        send_widget = self.sender_ui()
-        self.stacked_layout.addWidget(send_widget)
-
-        sending_widget = self.sending_ui()
-        self.sender_connecting_state()
-        self.stacked_layout.addWidget(sending_widget)
-
-        receiver_widget = self.receiver_ui()
-        self.stacked_layout.addWidget(receiver_widget)
+        self.show_page("main")
 
         self.main_layout = QVBoxLayout()
         self.main_layout.addWidget(titlebar)
@@ -815,23 +1182,36 @@ class MainWindow(QWidget):
 
         self.setLayout(self.main_layout)
 
+    def show_page(self, name):
+        page = self.pages.get(name)
+        if page is None:
+            page = self.pages[name] = self.page_builders[name]()
+            self.stacked_layout.addWidget(page)
+        self.stacked_layout.setCurrentWidget(page)
+
     def main_page(self):
-        self.stacked_layout.setCurrentIndex(0)
+        self.show_page("main")
 
     def settings_page(self):
+        self.show_page("settings")
         self.refresh_settings()
-        self.stacked_layout.setCurrentIndex(1)
 
     def sender_page(self):
-        self.stacked_layout.setCurrentIndex(2)
+        self.show_page("sender")
 
     def sending_page(self):
+        self.show_page("sending")
         self.sender_connecting_state()
-        self.stacked_layout.setCurrentIndex(3)
 
     def receiver_page(self):
+        self.show_page("receiver")
         self.receiver_connecting_state()
-        self.stacked_layout.setCurrentIndex(4)
+
+    def server_page(self):
+        self.show_page("server")
+        self.server_list.clear()
+        self.server_items = {}
+        self.server_header.setText(f"Listening on {self.host}:{self.port}")
 
     def titlebar_ui(self):
         app_icon = QPixmap("files/icon.png")
@@ -1110,6 +1490,18 @@ class MainWindow(QWidget):
                                     """
                                 )
 
+        self.listen_checkbox = QCheckBox("Keep Listening")
+        self.listen_checkbox.setStyleSheet(
+                                    """
+                                    QCheckBox
+                                    {
+                                        color: #808080; 
+                                        font-size: 14px; 
+                                        font-weight: 600;
+                                    }
+                                    """
+                                )
+
         note = QLabel("Note - Generally server side runs first, even though this application is designed to handle any order of execution")
         note.setStyleSheet(
                                     """
@@ -1136,6 +1528,8 @@ class MainWindow(QWidget):
         receive_button_layout.setAlignment(Qt.AlignCenter)
         receive_button_layout.addWidget(receiver_button)
         receive_button_layout.addWidget(server_header)
+        receive_button_layout.addWidget(self.listen_checkbox)
+        receive_button_layout.setAlignment(self.listen_checkbox, Qt.AlignHCenter)
 
         button_layout = QHBoxLayout()
         button_layout.setAlignment(Qt.AlignCenter)
@@ -1331,6 +1725,38 @@ class MainWindow(QWidget):
                                     """
                                 )
 
+        clients_caption = QLabel("Clients")
+        clients_caption.setAlignment(Qt.AlignVCenter)
+        clients_caption.setFixedWidth(80)
+        clients_caption.setStyleSheet(
+                                    """
+                                    QLabel
+                                    {
+                                        color: #A0A0A0; 
+                                        font-size: 14px; 
+                                        font-weight: 500;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        self.clients_textbox = QTextEdit()
+        self.clients_textbox.setAlignment(Qt.AlignCenter)
+        self.clients_textbox.setFixedHeight(45)
+        self.clients_textbox.setFixedWidth(80)
+        self.clients_textbox.setStyleSheet(
+                                    """
+                                    QTextEdit
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        border: 1px solid #555555;
+                                        border-radius: 5px;
+                                        padding: 6px 6px;
+                                    }
+                                    """
+                                )
+
         port_caption = QLabel("Port Number")
         port_caption.setAlignment(Qt.AlignVCenter)
         port_caption.setFixedWidth(120)
@@ -1362,6 +1788,228 @@ class MainWindow(QWidget):
                                     """
                                 )
 
+        compression_caption = QLabel("Compress")
+        compression_caption.setAlignment(Qt.AlignVCenter)
+        compression_caption.setFixedWidth(90)
+        compression_caption.setStyleSheet(
+                                    """
+                                    QLabel
+                                    {
+                                        color: #A0A0A0; 
+                                        font-size: 14px; 
+                                        font-weight: 500;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        self.compression_combobox = QComboBox()
+        self.compression_combobox.addItems(COMPRESSIONS)
+        self.compression_combobox.setFixedHeight(35)
+        self.compression_combobox.setStyleSheet(
+                                    """
+                                    QComboBox
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        border: 1px solid #555555;
+                                        border-radius: 5px;
+                                        padding: 4px 8px;
+                                    }
+
+                                    QComboBox QAbstractItemView
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        selection-background-color: #80AA80;
+                                    }
+                                    """
+                                )
+
+        profile_caption = QLabel("Profile")
+        profile_caption.setAlignment(Qt.AlignVCenter)
+        profile_caption.setFixedWidth(70)
+        profile_caption.setStyleSheet(
+                                    """
+                                    QLabel
+                                    {
+                                        color: #A0A0A0; 
+                                        font-size: 14px; 
+                                        font-weight: 500;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        self.profile_combobox = QComboBox()
+        self.profile_combobox.addItems(self.profiles)
+        self.profile_combobox.setFixedHeight(35)
+        self.profile_combobox.currentTextChanged.connect(self.profile_changed)
+        self.profile_combobox.setStyleSheet(
+                                    """
+                                    QComboBox
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        border: 1px solid #555555;
+                                        border-radius: 5px;
+                                        padding: 4px 8px;
+                                    }
+
+                                    QComboBox QAbstractItemView
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        selection-background-color: #80AA80;
+                                    }
+                                    """
+                                )
+
+        hash_caption = QLabel("Verify")
+        hash_caption.setAlignment(Qt.AlignVCenter)
+        hash_caption.setFixedWidth(60)
+        hash_caption.setStyleSheet(
+                                    """
+                                    QLabel
+                                    {
+                                        color: #A0A0A0; 
+                                        font-size: 14px; 
+                                        font-weight: 500;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        self.hash_combobox = QComboBox()
+        self.hash_combobox.addItems(HASHES)
+        self.hash_combobox.setToolTip("Verifies every block and the whole file. Reads the file through memory, so fast links lose the zero-copy send.")
+        self.hash_combobox.setFixedHeight(35)
+        self.hash_combobox.setStyleSheet(
+                                    """
+                                    QComboBox
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        border: 1px solid #555555;
+                                        border-radius: 5px;
+                                        padding: 4px 8px;
+                                    }
+
+                                    QComboBox QAbstractItemView
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        selection-background-color: #80AA80;
+                                    }
+                                    """
+                                )
+
+        self.nodelay_checkbox = QCheckBox("No Delay")
+        self.nodelay_checkbox.setStyleSheet(
+                                    """
+                                    QCheckBox
+                                    {
+                                        color: #A0A0A0; 
+                                        font-size: 14px; 
+                                        font-weight: 500;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        chunk_caption = QLabel("Chunk (KB)")
+        chunk_caption.setAlignment(Qt.AlignVCenter)
+        chunk_caption.setFixedWidth(100)
+        chunk_caption.setStyleSheet(
+                                    """
+                                    QLabel
+                                    {
+                                        color: #A0A0A0; 
+                                        font-size: 14px; 
+                                        font-weight: 500;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        self.chunk_textbox = QTextEdit()
+        self.chunk_textbox.setAlignment(Qt.AlignCenter)
+        self.chunk_textbox.setFixedHeight(45)
+        self.chunk_textbox.setStyleSheet(
+                                    """
+                                    QTextEdit
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        border: 1px solid #555555;
+                                        border-radius: 5px;
+                                        padding: 6px 6px;
+                                    }
+                                    """
+                                )
+
+        buffer_caption = QLabel("Buffer (KB)")
+        buffer_caption.setAlignment(Qt.AlignVCenter)
+        buffer_caption.setFixedWidth(100)
+        buffer_caption.setStyleSheet(
+                                    """
+                                    QLabel
+                                    {
+                                        color: #A0A0A0; 
+                                        font-size: 14px; 
+                                        font-weight: 500;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        self.buffer_textbox = QTextEdit()
+        self.buffer_textbox.setAlignment(Qt.AlignCenter)
+        self.buffer_textbox.setFixedHeight(45)
+        self.buffer_textbox.setStyleSheet(
+                                    """
+                                    QTextEdit
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        border: 1px solid #555555;
+                                        border-radius: 5px;
+                                        padding: 6px 6px;
+                                    }
+                                    """
+                                )
+
+        streams_caption = QLabel("Streams")
+        streams_caption.setAlignment(Qt.AlignVCenter)
+        streams_caption.setFixedWidth(80)
+        streams_caption.setStyleSheet(
+                                    """
+                                    QLabel
+                                    {
+                                        color: #A0A0A0; 
+                                        font-size: 14px; 
+                                        font-weight: 500;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        self.streams_textbox = QTextEdit()
+        self.streams_textbox.setAlignment(Qt.AlignCenter)
+        self.streams_textbox.setFixedHeight(45)
+        self.streams_textbox.setStyleSheet(
+                                    """
+                                    QTextEdit
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        border: 1px solid #555555;
+                                        border-radius: 5px;
+                                        padding: 6px 6px;
+                                    }
+                                    """
+                                )
+
         reset_caption = QLabel("Reset")
         reset_caption.setAlignment(Qt.AlignVCenter)
         reset_caption.setFixedWidth(53)
@@ -1411,10 +2059,20 @@ class MainWindow(QWidget):
                                 )
         
         reset_layout = QHBoxLayout()
+        reset_layout.addSpacing(5)
+        reset_layout.addWidget(profile_caption)
+        reset_layout.addSpacing(5)
+        reset_layout.addWidget(self.profile_combobox)
+        reset_layout.addSpacing(5)
+        reset_layout.addWidget(hash_caption)
+        reset_layout.addWidget(self.hash_combobox)
+        reset_layout.addSpacing(5)
+        reset_layout.addWidget(self.nodelay_checkbox)
         reset_layout.addWidget(reset_caption)
         reset_layout.setAlignment(reset_caption, Qt.AlignRight)
         reset_layout.addWidget(reset_button)
         reset_layout.setAlignment(reset_button, Qt.AlignLeft)
+        reset_layout.addSpacing(5)
 
         saves_layout = QHBoxLayout()
         saves_layout.addSpacing(5)
@@ -1429,6 +2087,9 @@ class MainWindow(QWidget):
         host_layout.addSpacing(5)
         host_layout.addWidget(self.host_textbox)
         host_layout.addSpacing(5)
+        host_layout.addWidget(clients_caption)
+        host_layout.addWidget(self.clients_textbox)
+        host_layout.addSpacing(5)
 
         port_layout = QHBoxLayout()
         port_layout.addSpacing(5)
@@ -1436,11 +2097,28 @@ class MainWindow(QWidget):
         port_layout.addSpacing(5)
         port_layout.addWidget(self.port_textbox)
         port_layout.addSpacing(5)
+        port_layout.addWidget(compression_caption)
+        port_layout.addWidget(self.compression_combobox)
+        port_layout.addSpacing(5)
+
+        tuning_layout = QHBoxLayout()
+        tuning_layout.addSpacing(5)
+        tuning_layout.addWidget(chunk_caption)
+        tuning_layout.addSpacing(5)
+        tuning_layout.addWidget(self.chunk_textbox)
+        tuning_layout.addSpacing(5)
+        tuning_layout.addWidget(buffer_caption)
+        tuning_layout.addWidget(self.buffer_textbox)
+        tuning_layout.addSpacing(5)
+        tuning_layout.addWidget(streams_caption)
+        tuning_layout.addWidget(self.streams_textbox)
+        tuning_layout.addSpacing(5)
 
         central_layout = QVBoxLayout()
         central_layout.addLayout(saves_layout)
         central_layout.addLayout(host_layout)
         central_layout.addLayout(port_layout)
+        central_layout.addLayout(tuning_layout)
         central_layout.addLayout(reset_layout)
 
         button_layout = QHBoxLayout()
@@ -1454,9 +2132,7 @@ class MainWindow(QWidget):
         settings_layout.setAlignment(Qt.AlignCenter)
         settings_layout.addWidget(header)
         settings_layout.setAlignment(header, Qt.AlignTop)
-        settings_layout.addSpacing(10)
         settings_layout.addLayout(central_layout)
-        settings_layout.addSpacing(10)
         settings_layout.addLayout(button_layout)
         settings_layout.setAlignment(button_layout, Qt.AlignBottom)
         settings_layout.addSpacing(10)
@@ -1526,7 +2202,7 @@ class MainWindow(QWidget):
 
         cancel_button = QPushButton("CANCEL")
         cancel_button.setFixedSize(130, 40)
-        cancel_button.clicked.connect(self.close_sender_thread)
+        cancel_button.clicked.connect(self.close_sender_task)
         cancel_button.setStyleSheet(
                                     """
                                     QPushButton {
@@ -1615,7 +2291,7 @@ class MainWindow(QWidget):
 
         cancel_button = QPushButton("CANCEL")
         cancel_button.setFixedSize(130, 40)
-        cancel_button.clicked.connect(self.close_receiver_thread)
+        cancel_button.clicked.connect(self.close_receiver_task)
         cancel_button.setStyleSheet(
                                     """
                                     QPushButton {
@@ -1710,6 +2386,82 @@ class MainWindow(QWidget):
 
         return receiver_widget
 
+    def server_ui(self):
+        self.server_header = QLabel("Listening")
+        self.server_header.setAlignment(Qt.AlignCenter)
+        self.server_header.setStyleSheet(
+                                    """
+                                    QLabel
+                                    {
+                                        color: #CCCCCC; 
+                                        font-size: 20px; 
+                                        font-weight: 600;
+                                        padding: 8px 8px;
+                                    }
+                                    """
+                                )
+
+        self.server_list = QListWidget()
+        self.server_list.setFixedWidth(560)
+        self.server_list.setStyleSheet(
+                                    """
+                                    QListWidget
+                                    {
+                                        background-color: #202020; 
+                                        color: #CCCCCC; 
+                                        border: 1px solid #555555;
+                                        border-radius: 5px;
+                                        font-size: 14px; 
+                                        padding: 6px 6px;
+                                    }
+                                    """
+                                )
+
+        stop_button = QPushButton("STOP")
+        stop_button.setFixedSize(130, 40)
+        stop_button.clicked.connect(self.close_server_task)
+        stop_button.setStyleSheet(
+                                    """
+                                    QPushButton {
+                                        font-size: 15px;
+                                        font-weight: 800;
+                                        padding: 8px 8px;
+                                        border-radius: 5px;
+
+                                        background-color: #151515;
+                                        border: 1px solid #555555;
+                                        color: #CCCCCC;
+                                    }
+                                    
+                                    QPushButton:hover {
+                                        background-color: #AA8080;
+                                        border: 0px solid #555555;
+                                        color: #101010;
+                                    }
+                                    
+                                    QPushButton:pressed {
+                                        background-color: #444444;
+                                        border: 2px solid #777777;
+                                        color: #CCCCCC;
+                                    }
+                                    """
+                                )
+
+        server_layout = QVBoxLayout()
+        server_layout.addWidget(self.server_header)
+        server_layout.setAlignment(self.server_header, Qt.AlignTop | Qt.AlignHCenter)
+        server_layout.addWidget(self.server_list)
+        server_layout.setAlignment(self.server_list, Qt.AlignHCenter)
+        server_layout.addSpacing(10)
+        server_layout.addWidget(stop_button)
+        server_layout.setAlignment(stop_button, Qt.AlignBottom | Qt.AlignHCenter)
+        server_layout.addSpacing(10)
+
+        server_widget = QWidget()
+        server_widget.setLayout(server_layout)
+
+        return server_widget
+
     def sender_ui(self):
         header = QLabel("Select file")
         header.setAlignment(Qt.AlignCenter)
@@ -1755,6 +2507,37 @@ class MainWindow(QWidget):
                                     """
                                 )
 
+        folder_button = QPushButton()
+        folder_button.setIcon(QFileIconProvider().icon(QFileIconProvider.Folder))
+        folder_button.setFixedSize(60, 50)
+        folder_button.clicked.connect(self.open_folder_dialog)
+        folder_button.setStyleSheet(
+                                    """
+                                    QPushButton {
+                                        font-size: 15px;
+                                        font-weight: 800;
+                                        padding: 8px 8px;
+                                        border-radius: 5px;
+
+                                        background-color: #151515;
+                                        border: 1px solid #555555;
+                                        color: #CCCCCC;
+                                    }
+                                    
+                                    QPushButton:hover {
+                                        background-color: #AA8080;
+                                        border: 0px solid #555555;
+                                        color: #101010;
+                                    }
+                                    
+                                    QPushButton:pressed {
+                                        background-color: #444444;
+                                        border: 2px solid #777777;
+                                        color: #CCCCCC;
+                                    }
+                                    """
+                                )
+
         back_button = QPushButton("BACK")
         back_button.setFixedSize(130, 40)
         back_button.clicked.connect(self.main_page)
@@ -1874,6 +2657,7 @@ class MainWindow(QWidget):
         file_info_layout.addWidget(self.file_size_label)
         file_info_layout.addSpacing(5)
         file_info_layout.addWidget(file_button)
+        file_info_layout.addWidget(folder_button)
         file_info_layout.addSpacing(5)
 
         file_info_widget = QWidget()
@@ -1922,18 +2706,42 @@ class MainWindow(QWidget):
 
     def open_file_dialog(self):
         file_dialog = QFileDialog()
-        self.sending_file_path, _ = file_dialog.getOpenFileName(
-            self, "Open File", "", "All Files (*)"
+        file_paths, _ = file_dialog.getOpenFileNames(
+            self, "Open Files", "", "All Files (*)"
         )
-        if self.sending_file_path:
-            self.file_path_label.setText(f"File Path: {self.sending_file_path}")
-            file_size = os.path.getsize(self.sending_file_path)
-            formatted_size = self.format_file_size(file_size)
-            self.file_size_label.setText(f"{formatted_size}")
-            self.set_file_icon(self.sending_file_path)
+        if file_paths:
+            self.set_sending_paths(file_paths)
 
-            self.file_path_label.adjustSize()
-            self.file_size_label.adjustSize()
+    def open_folder_dialog(self):
+        folder_dialog = QFileDialog()
+        folder_path = folder_dialog.getExistingDirectory(self, "Open Folder")
+        if folder_path:
+            self.set_sending_paths([folder_path])
+
+    def set_sending_paths(self, paths):
+        self.sending_paths = paths
+        if len(paths) == 1 and os.path.isfile(paths[0]):
+            self.file_path_label.setText(f"File Path: {paths[0]}")
+            file_size = os.path.getsize(paths[0])
+            self.set_file_icon(paths[0])
+        else:
+            # Counted the way the sender builds the batch, which skips
+            # anything that is not a regular file, broken links included.
+            try:
+                batch = Batch.from_paths(paths)
+                file_size = batch.size
+                self.file_path_label.setText(f"{len(batch.members)} Files In: {os.path.commonpath(paths)}")
+            except OSError as error:
+                file_size = 0
+                self.file_path_label.setText(f"Cannot read: {error}")
+            self.thumbnails.cancel()
+            self.file_icon_label.setPixmap(QFileIconProvider().icon(QFileIconProvider.Folder).pixmap(48, 48))
+
+        formatted_size = self.format_file_size(file_size)
+        self.file_size_label.setText(f"{formatted_size}")
+
+        self.file_path_label.adjustSize()
+        self.file_size_label.adjustSize()
 
     @staticmethod
     def format_file_size(size):
@@ -1960,58 +2768,20 @@ class MainWindow(QWidget):
         file_info = QFileInfo(file_path)
         file_extension = file_info.suffix().lower()
 
+        # The file icon stays up as the placeholder until the thumbnail is in.
         if file_extension in image_extensions:
-            self.show_image_preview(file_path)
+            self.thumbnails.request(file_path, image_thumbnail)
         elif file_extension in video_extensions:
-            self.show_video_preview(file_path)
+            self.thumbnails.request(file_path, video_thumbnail)
         else:
             self.show_default_preview(file_path)
 
-    def show_image_preview(self, file_path):
-        image = QImage(file_path)
-
-        width = image.width()
-        height = image.height()
-        size = min(width, height)
-
-        start_x = (width - size) // 2
-        start_y = (height - size) // 2
-
-        cropped_image = QImage(size, size, QImage.Format_RGB32)
-        painter = QPainter(cropped_image)
-        painter.drawImage(0, 0, image, start_x, start_y, size, size)
-        painter.end()
-
-        pixmap = QPixmap.fromImage(cropped_image)
-        pixmap = pixmap.scaled(128, 128, Qt.AspectRatioMode.KeepAspectRatio, Qt.SmoothTransformation)
-
-        self.file_icon_label.setPixmap(pixmap)
-
-    def show_video_preview(self, file_path):
-        cap = cv2.VideoCapture(file_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        center_frame = total_frames // 4
-        cap.set(cv2.CAP_PROP_POS_FRAMES, center_frame)
-        _, frame = cap.read()
-        cap.release()
-        cv2.destroyAllWindows()
-
-        height, width = frame.shape[:2]
-        size = min(height, width)
-        start_x = (width - size) // 2
-        start_y = (height - size) // 2
-        frame = frame[start_y:start_y+size, start_x:start_x+size]
-
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        height, width, channel = rgb_frame.shape
-        bytes_per_line = channel * width
-        image = QImage(rgb_frame.data, width, height, bytes_per_line, QImage.Format_RGB888)
-
-        pixmap = QPixmap.fromImage(image)
-        pixmap = pixmap.scaled(128, 128, Qt.AspectRatioMode.KeepAspectRatio, Qt.SmoothTransformation)
-        self.file_icon_label.setPixmap(pixmap)
+    def thumbnail_ready(self, number, image):
+        if number == self.thumbnails.number:
+            self.file_icon_label.setPixmap(QPixmap.fromImage(image))
 
     def show_default_preview(self, file_path):
+        self.thumbnails.cancel()
         icon = QIcon.fromTheme("text-x-generic")
         file_info = QFileInfo(file_path)
         if file_info.exists() and file_info.isFile():
@@ -2028,8 +2798,13 @@ class MainWindow(QWidget):
         self.sending_file_dir.hide()
         self.sending_header.setText("Trying to Connecting")
 
-        self.sending_file_dir.setText(os.path.dirname(self.sending_file_path))
-        self.sending_file_name.setText(os.path.basename(self.sending_file_path))
+        if len(self.sending_paths) == 1:
+            sending_path = os.path.normpath(self.sending_paths[0])
+            self.sending_file_dir.setText(os.path.dirname(sending_path))
+            self.sending_file_name.setText(os.path.basename(sending_path))
+        else:
+            self.sending_file_dir.setText(os.path.commonpath(self.sending_paths))
+            self.sending_file_name.setText(f"{len(self.sending_paths)} Items")
 
     def sender_sending_state(self):
         self.senter_loading_icon.stop_animation()
@@ -2039,28 +2814,24 @@ class MainWindow(QWidget):
         self.sending_file_name.show()
         self.sending_file_dir.show()
 
-        file_size = os.path.getsize(self.sending_file_path)
-        self.sender_progressbar.set_maximum_data(file_size)
+        self.sender_progressbar.set_maximum_data(self.sender_task.batch.size)
+        self.sender_progressbar.set_batch(self.sender_task.batch)
         self.sending_header.setText("Sending File")
 
-        self.sender_transfer_rate = 0
-        self.sender_timer = QTimer()
-        self.sender_timer.setInterval(200)
-        self.sender_timer.timeout.connect(self.sender_rate_update)
-        self.sender_timer_started = False
+        self.sender_progressbar.set_rates(self.sender_task.meter)
+        self.sender_progress_timer.start()
+        self.sender_timer.start()
 
-    def sender_progress_update(self, progress):
-        if not self.sender_timer_started:
-            self.sender_timer.start()
-            self.sender_timer_started = True
-        self.sender_transfer_rate += 1024
-        self.sender_progressbar.set_current_data(progress)
+    def sender_progress_update(self):
+        progress = self.sender_task.counter.sample()
+        if progress is not None:
+            self.sender_progressbar.set_current_data(progress)
 
     def sender_rate_update(self):
-        self.sender_progressbar.set_transfer_rate(self.sender_transfer_rate * 5)
-        self.sender_transfer_rate = 0
+        self.sender_progressbar.set_rates(self.sender_task.meter)
 
     def sender_finished_state(self):
+        self.stop_sender_timers()
         self.senter_loading_icon.stop_animation()
         self.senter_loading_icon.hide()
         self.sender_progressbar.hide()
@@ -2069,11 +2840,17 @@ class MainWindow(QWidget):
         self.sender_finished_animation.show()
         self.sending_header.setText("Successful")
 
-    def close_sender_thread(self):
-        self.sender_thread.stop()
+    def stop_sender_timers(self):
+        self.sender_progress_timer.stop()
+        self.sender_timer.stop()
+
+    def close_sender_task(self):
+        self.stop_sender_timers()
+        self.sender_task.stop()
         self.sender_page()
 
     def sender_transfer_failed(self):
+        self.stop_sender_timers()
         self.sender_page()
 
     def receiver_connecting_state(self):
@@ -2093,23 +2870,19 @@ class MainWindow(QWidget):
         self.receiver_header.setText("Receiving File")
 
         self.receiver_file_name.setText(file_name)
+        self.receiver_progressbar.set_batch(self.receiver_task.batch)
 
-        self.receiver_transfer_rate = 0
-        self.receiver_timer = QTimer()
-        self.receiver_timer.setInterval(200)
-        self.receiver_timer.timeout.connect(self.receiver_rate_update)
-        self.receiver_timer_started = False
+        self.receiver_progressbar.set_rates(self.receiver_task.meter)
+        self.receiver_progress_timer.start()
+        self.receiver_timer.start()
 
-    def receiver_progress_update(self, progress):
-        if not self.receiver_timer_started:
-            self.receiver_timer.start()
-            self.receiver_timer_started = True
-        self.receiver_transfer_rate += 1024
-        self.receiver_progressbar.set_current_data(progress)
+    def receiver_progress_update(self):
+        progress = self.receiver_task.counter.sample()
+        if progress is not None:
+            self.receiver_progressbar.set_current_data(progress)
 
     def receiver_rate_update(self):
-        self.receiver_progressbar.set_transfer_rate(self.receiver_transfer_rate * 5)
-        self.receiver_transfer_rate = 0
+        self.receiver_progressbar.set_rates(self.receiver_task.meter)
 
     def receiver_finished_state(self):
         self.receiver_loading_icon.stop_animation()
@@ -2118,44 +2891,100 @@ class MainWindow(QWidget):
         self.receiver_file_name.hide()
         self.receiver_finished_animation.show()
         self.receiver_header.setText("Successful")
+        self.stop_receiver_timers()
+
+    def stop_receiver_timers(self):
+        self.receiver_progress_timer.stop()
         self.receiver_timer.stop()
 
-    def close_receiver_thread(self):
-        if not self.receiver_thread.connected:
-            self.receiver_thread.quit()
-        self.receiver_thread.stop()
+    def close_receiver_task(self):
+        self.stop_receiver_timers()
+        self.receiver_task.stop()
         self.main_page()
 
     def receiver_transfer_failed(self):
+        self.stop_receiver_timers()
+        self.main_page()
+
+    def server_transfer_started(self, number, file_name, file_size):
+        item = QListWidgetItem()
+        self.server_list.addItem(item)
+        self.server_items[number] = (item, file_name, file_size)
+        self.server_item_update(number, 0)
+
+    def server_progress_update(self):
+        for number in self.server_items:
+            counter = self.server_task.counters.get(number)
+            progress = counter.sample() if counter is not None else None
+            if progress is not None:
+                self.server_item_update(number, progress)
+
+    def server_item_update(self, number, progress):
+        item, file_name, file_size = self.server_items[number]
+        percentage = round(progress / file_size * 100) if file_size else 100
+        item.setText(f"{file_name}    {Progressbar_Widget.format_file_size(progress)} / {Progressbar_Widget.format_file_size(file_size)}    {percentage} %")
+
+    def server_transfer_finished(self, number):
+        if number in self.server_items:
+            item, file_name, file_size = self.server_items.pop(number)
+            self.server_task.counters.pop(number, None)
+            item.setText(f"{file_name}    {Progressbar_Widget.format_file_size(file_size)}    Received")
+
+    def server_transfer_failed(self, number):
+        if number in self.server_items:
+            item, file_name, _ = self.server_items.pop(number)
+            self.server_task.counters.pop(number, None)
+            item.setText(f"{file_name}    Failed")
+
+    def server_failed(self, message):
+        self.server_progress_timer.stop()
+        self.server_header.setText(f"Not listening: {message}")
+
+    def close_server_task(self):
+        self.server_progress_timer.stop()
+        self.server_task.stop()
         self.main_page()
 
     # Sender
     def send(self):
-        if os.path.isfile(self.sending_file_path):
+        if self.sending_paths and all(os.path.exists(path) for path in self.sending_paths):
             self.sending_page()
 
-            self.sender_thread = SenderThread(self.host, self.port, self.sending_file_path)
-            self.sender_thread.connectionEstablished.connect(self.sender_sending_state)
-            self.sender_thread.progressChanged.connect(self.sender_progress_update)
-            self.sender_thread.transferFailed.connect(self.sender_transfer_failed)
-            self.sender_thread.fileRecieved.connect(self.sender_finished_state)
-            self.sender_thread.start()
+            self.sender_task = SenderTask(self.transfer_loop, self.host, self.port, self.sending_paths, self.transfer_settings())
+            self.sender_task.connectionEstablished.connect(self.sender_sending_state)
+            self.sender_task.transferFailed.connect(self.sender_transfer_failed)
+            self.sender_task.fileRecieved.connect(self.sender_finished_state)
+            self.sender_task.start()
 
     # Reciever
     def receive(self):
-        if os.path.isdir(self.save_path):
+        if self.listen_checkbox.isChecked():
+            self.serve()
+        elif os.path.isdir(self.save_path):
             self.receiver_page()
 
-            self.receiver_thread = ReceiverThread(self.host, self.port, self.save_path)
-            self.receiver_thread.connectionEstablished.connect(self.receiver_receiving_state)
-            self.receiver_thread.progressChanged.connect(self.receiver_progress_update)
-            self.receiver_thread.transferFailed.connect(self.receiver_transfer_failed)
-            self.receiver_thread.fileRecieved.connect(self.receiver_finished_state)
-            self.receiver_thread.fileSize.connect(self.receiver_progressbar.set_maximum_data)
-            self.receiver_thread.start()
+            self.receiver_task = ReceiverTask(self.transfer_loop, self.host, self.port, self.save_path, self.transfer_settings())
+            self.receiver_task.connectionEstablished.connect(self.receiver_receiving_state)
+            self.receiver_task.transferFailed.connect(self.receiver_transfer_failed)
+            self.receiver_task.fileRecieved.connect(self.receiver_finished_state)
+            self.receiver_task.fileSize.connect(self.receiver_progressbar.set_maximum_data)
+            self.receiver_task.start()
+
+    # Persistent receiver
+    def serve(self):
+        if os.path.isdir(self.save_path):
+            self.server_page()
+
+            self.server_task = ServerTask(self.transfer_loop, self.host, self.port, self.save_path, self.transfer_settings(), self.clients)
+            self.server_task.transferStarted.connect(self.server_transfer_started)
+            self.server_task.transferFailed.connect(self.server_transfer_failed)
+            self.server_task.fileRecieved.connect(self.server_transfer_finished)
+            self.server_task.serverFailed.connect(self.server_failed)
+            self.server_task.start()
+            self.server_progress_timer.start()
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = MainWindow(app)
     window.show()
-    app.exec()
\ No newline at end of file
+    app.exec()
@@ -0,0 +1,774 @@
+import os
+import time
+import socket
+import struct
+import asyncio
+import threading
+import collections
+
+from phantomfile import (FileSender, FileReceiver, ReceiverServer, Batch, BatchFile, MappedFile, Codec,
+                         DiskQueue, ProtocolError, new_hash, root_digest, segments, merge_ranges, flush_due,
+                         pack_ranges, pack_digests, unpack_stream, pack_stream, pack_manifest, endpoint, listen,
+                         FRAME, OFFSET, CHUNK, SENDFILE_SLICE, ACK_INTERVAL, JOURNAL_INTERVAL,
+                         PROBE_PINGS, PROBE_SIZE, PROBE_MIN_FILE_SIZE, STREAM_TIMEOUT, MAX_TRANSFERS,
+                         HEADER, ACK, CANCEL, DONE, PING, PONG, PROBE, TUNE, STREAM, RANGES, DIGEST, TRAILER,
+                         DATA, MANIFEST)
+
+# The phantomfile protocol on asyncio. Transfers are tasks on one event loop
+# instead of a thread each, and stop() cancels the task, which interrupts a
+# pending connect, accept, send or receive right away instead of waiting for
+# it to return. Protocol state, journals, batches and codecs are shared with
+# the blocking engine, only the socket I/O differs. Disk reads and writes,
+# hashing and compression run on a disk queue per stream, and allocation,
+# journals and syncs in the default executor, so a slow disk holds up its
+# own transfer but never the loop. Network waits in the metrics are the time
+# a stream spends awaiting its socket, which includes other tasks' turns.
+
+async def recv_exact(loop, sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    filled = 0
+    while filled < size:
+        count = await loop.sock_recv_into(sock, view[filled:])
+        if not count:
+            raise ConnectionError("Connection closed by peer")
+        filled += count
+    return bytes(buffer)
+
+async def send_frame(loop, sock, kind, payload=b""):
+    await loop.sock_sendall(sock, FRAME.pack(kind, len(payload)) + payload)
+
+async def recv_frame(loop, sock):
+    kind, length = FRAME.unpack(await recv_exact(loop, sock, FRAME.size))
+    return kind, await recv_exact(loop, sock, length)
+
+class EventLoopThread(threading.Thread):
+    # Runs one loop for every transfer of the process. submit() may be called
+    # from any thread and returns a concurrent future.
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class AsyncDiskQueue(DiskQueue):
+    # The disk queue of the blocking engine for a stream task. Jobs run off
+    # the loop and the task awaits them, so a stream's disk work overlaps the
+    # socket waits of every transfer on the loop. A depth of 0 gives the
+    # stream no thread of its own: each job goes to the loop's default
+    # executor and is awaited before the next, which keeps them in order.
+    # Mappings get buffers too, touching their pages may fault them in.
+    def __init__(self, file, depth, size, metrics):
+        super().__init__(file, depth, size, metrics)
+        self.free = [bytearray(size) for _ in range(max(depth + 1, 2))]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def result(self, future):
+        clock = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            self.metrics.add(disk_wait_seconds=time.perf_counter() - clock)
+
+    async def wait(self):
+        future, buffer = self.pending.popleft()
+        try:
+            await self.result(future)
+        finally:
+            if buffer is not None:
+                self.free.append(buffer)
+
+    async def take(self):
+        while not self.free:
+            await self.wait()
+        return self.free.pop()
+
+    def start(self, function, *args):
+        if self.executor is not None:
+            return self.executor.submit(self.call, function, *args)
+        return asyncio.get_running_loop().run_in_executor(None, self.call, function, *args)
+
+    async def submit(self, function, *args, buffer=None):
+        while self.pending and len(self.pending) >= self.depth:
+            await self.wait()
+        self.pending.append((self.start(function, *args), buffer))
+        if not self.depth:
+            await self.wait()
+
+    async def write_at(self, buffer, view, offset, then=None, hasher=None):
+        # The block is hashed in the same job that writes it, its digest is
+        # ready once the last write of the block is done.
+        def write():
+            if hasher is not None:
+                clock = time.perf_counter()
+                hasher.update(view)
+                self.metrics.add(hash_seconds=time.perf_counter() - clock)
+            self.file.write_at(view, offset)
+            if then is not None:
+                then(len(view))
+        await self.submit(write, buffer=buffer)
+
+    async def read_ahead(self, offset, end, chunk_size, then=None):
+        # Yields (size, data) chunk by chunk with up to depth reads running
+        # ahead. then turns a chunk into the data to send off the loop, in
+        # file order, so without a helper thread one read runs at a time.
+        # Callers close the generator when they stop early, reads still in
+        # flight own their buffers until they return.
+        def read(view, offset):
+            if self.file.read_at(view, offset) < len(view):
+                raise EOFError("File is shorter than announced")
+            return view if then is None else then(view)
+
+        reads = collections.deque()
+        held = None
+        try:
+            while reads or offset < end:
+                while self.free and offset < end and (self.depth or not reads):
+                    buffer = self.free.pop()
+                    view = memoryview(buffer)[:min(chunk_size, end - offset)]
+                    reads.append((self.start(read, view, offset), buffer, len(view)))
+                    offset += len(view)
+                future, buffer, size = reads[0]
+                data = await self.result(future)
+                reads.popleft()
+                held = buffer
+                yield size, data
+                self.free.append(held)
+                held = None
+        finally:
+            await asyncio.gather(*[asyncio.wrap_future(future) for future, _, _ in reads], return_exceptions=True)
+            self.free.extend(buffer for _, buffer, _ in reads)
+            if held is not None:
+                self.free.append(held)
+
+    async def close(self):
+        try:
+            while self.pending:
+                await self.wait()
+        finally:
+            # After a failure the queued jobs are dropped, the running one
+            # still uses the file and is waited for.
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            running = [asyncio.wrap_future(future) for future, _ in self.pending]
+            self.pending.clear()
+            await asyncio.gather(*running, return_exceptions=True)
+
+class AsyncFileSender(FileSender):
+    def __init__(self, host: str, port: int, file_path, settings=None):
+        super().__init__(host, port, file_path, settings)
+        self.loop = None
+        self.task = None
+
+    def stop(self):
+        self.stop_request = True
+        if self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    async def connect(self):
+        while not self.stop_request:
+            family, address = endpoint(self.host, self.port)
+            client = socket.socket(family, socket.SOCK_STREAM)
+            self.settings.configure(client, socket.SO_SNDBUF)
+            client.setblocking(False)
+            try:
+                await self.loop.sock_connect(client, address)
+                self.sockets.append(client)
+                return client
+            except (ConnectionRefusedError, FileNotFoundError):
+                client.close()
+                print("Connection refused. Retrying in 2 seconds...")
+                await asyncio.sleep(2)
+        return None
+
+    async def measure(self):
+        rtt = float("inf")
+        for index in range(PROBE_PINGS):
+            start = time.perf_counter()
+            await send_frame(self.loop, self.client, PING, OFFSET.pack(index))
+            if (await recv_frame(self.loop, self.client))[0] != PONG:
+                raise ProtocolError("Expected pong frame")
+            rtt = min(rtt, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await send_frame(self.loop, self.client, PROBE, bytes(PROBE_SIZE))
+        if (await recv_frame(self.loop, self.client))[0] != ACK:
+            raise ProtocolError("Expected probe acknowledgement")
+        elapsed = time.perf_counter() - start
+        return rtt, PROBE_SIZE / max(elapsed - rtt, rtt, 1e-6)
+
+    async def handshake(self, header):
+        if self.settings.auto and header.size >= PROBE_MIN_FILE_SIZE:
+            self.settings.tune(*await self.measure())
+            self.settings.configure(self.client, socket.SO_SNDBUF)
+            await send_frame(self.loop, self.client, TUNE, CHUNK.pack(self.settings.chunk_size))
+
+        self.announce(header)
+        await send_frame(self.loop, self.client, HEADER, header.pack())
+        if header.files is not None:
+            await send_frame(self.loop, self.client, MANIFEST, pack_manifest(self.batch.members))
+
+        kind, payload = await recv_frame(self.loop, self.client)
+        if kind != RANGES:
+            raise ProtocolError("Expected missing ranges")
+        streams = self.plan(header, payload)
+        if self.settings.hash_name:
+            self.resume_digests(header, *await recv_frame(self.loop, self.client))
+        return streams
+
+    async def read_control(self):
+        try:
+            while True:
+                kind, payload = await recv_frame(self.loop, self.client)
+                if kind == ACK:
+                    (self.acknowledged,) = OFFSET.unpack(payload)
+                    self.meter.update(self.acknowledged)
+                    self.on_progress(self.acknowledged)
+                elif kind == DONE:
+                    self.finished = True
+                    return
+                elif kind == CANCEL:
+                    self.cancelled = True
+                    self.stop()
+                    return
+        except (OSError, ConnectionError, struct.error):
+            return
+
+    async def send_zero_copy(self, sock, file, offset, count, index):
+        calls = total = 0
+        clock = time.perf_counter()
+        try:
+            for member, member_offset, size in file.batch.pieces(offset, count):
+                for member_offset, size in segments(member_offset, size, SENDFILE_SLICE):
+                    sent = await self.loop.sock_sendfile(sock, file.member(member), member_offset, size)
+                    calls += 1
+                    total += sent
+                    if sent < size:
+                        raise EOFError("File is shorter than announced")
+                    self.sent[index] += sent
+        finally:
+            self.metrics.add(sendfile_calls=calls, sendfile_seconds=time.perf_counter() - clock,
+                             bytes_sent=total, payload_bytes=total)
+
+    def prepare(self, hasher=None, codec=None):
+        # Runs on the disk queue right after each read, so the hasher and the
+        # codec see the chunks in file order and off the loop.
+        def prepare(view):
+            if hasher is not None:
+                clock = time.perf_counter()
+                hasher.update(view)
+                self.metrics.add(hash_seconds=time.perf_counter() - clock)
+            if codec is None:
+                return view
+            clock = time.perf_counter()
+            flag, data = codec.pack(view)
+            frame = b"".join((FRAME.pack(DATA, 1 + len(data)), bytes([flag]), data))
+            self.metrics.add(compress_seconds=time.perf_counter() - clock)
+            return frame
+        return prepare
+
+    async def send_buffered(self, sock, disk, offset, count, index, hasher=None, codec=None):
+        start = offset
+        calls = wire = 0
+        network = 0.0
+        chunks = disk.read_ahead(offset, offset + count, self.settings.chunk_size, self.prepare(hasher, codec))
+        try:
+            async for size, data in chunks:
+                clock = time.perf_counter()
+                await self.loop.sock_sendall(sock, data)
+                network += time.perf_counter() - clock
+                calls += 1
+                wire += len(data)
+                offset += size
+                self.sent[index] += size
+        finally:
+            await chunks.aclose()
+            self.metrics.add(disk_read_calls=calls, socket_send_calls=calls, network_wait_seconds=network,
+                             bytes_sent=wire, payload_bytes=offset - start)
+
+    async def send_blocks(self, sock, disk, offset, count, index, codec=None):
+        hash_name = self.settings.hash_name
+        for offset, count in segments(offset, count):
+            hasher = new_hash(hash_name) if hash_name else None
+            await self.send_buffered(sock, disk, offset, count, index, hasher, codec)
+            if hasher is not None:
+                digest = hasher.digest()
+                await send_frame(self.loop, sock, DIGEST, digest)
+                self.digests.append((offset, digest))
+
+    async def send_stream(self, sock, transfer_id, index, count, ranges):
+        try:
+            await send_frame(self.loop, sock, STREAM, pack_stream(transfer_id, index, count, ranges))
+            codec = Codec(self.codec) if self.codec else None
+            zero_copy = self.zero_copy and self.batch.size >= len(self.batch.members) * self.settings.chunk_size
+            if zero_copy and not codec and not self.settings.hash_name:
+                with BatchFile(self.batch, 'rb') as file:
+                    for offset, count in ranges:
+                        await self.send_zero_copy(sock, file, offset, count, index)
+                return
+            with (MappedFile if self.settings.maps(self.batch.size) else BatchFile)(self.batch, 'rb') as file:
+                async with AsyncDiskQueue(file, self.settings.pipeline, self.settings.chunk_size, self.metrics) as disk:
+                    for offset, count in ranges:
+                        if codec or self.settings.hash_name:
+                            await self.send_blocks(sock, disk, offset, count, index, codec)
+                        else:
+                            await self.send_buffered(sock, disk, offset, count, index)
+        except (OSError, EOFError) as error:
+            print("Stream {} failed: {}".format(index, error))
+            self.stop()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        if self.stop_request:
+            return
+
+        try:
+            await self.loop.run_in_executor(None, self.load_batch)
+        except OSError as error:
+            print("Cannot read files:", error)
+            self.on_failed()
+            return
+        header = self.header
+
+        control = None
+        workers = []
+        try:
+            with self.metrics.span("connect"):
+                self.client = await self.connect()
+            if self.client is None:
+                return
+
+            with self.metrics.span("handshake"):
+                streams = await self.handshake(header)
+            with self.metrics.span("streams"):
+                connections = [self.client] + [await self.connect() for _ in streams[1:]]
+            if None in connections:
+                raise ConnectionError("Sender stopped")
+            self.sent = [0] * len(streams)
+            self.meter.update(self.acknowledged)
+            self.on_connected()
+            control = asyncio.ensure_future(self.read_control())
+
+            with self.metrics.span("transfer"):
+                for index, (sock, ranges) in enumerate(zip(connections, streams)):
+                    workers.append(asyncio.ensure_future(self.send_stream(sock, header.transfer_id, index, len(streams), ranges)))
+                await asyncio.gather(*workers)
+
+            if self.settings.hash_name and not self.stop_request:
+                await send_frame(self.loop, self.client, TRAILER, root_digest(self.settings.hash_name, self.digests))
+            await control
+        except asyncio.CancelledError:
+            self.stop_request = True
+        except (OSError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            for task in workers + [control]:
+                if task is not None:
+                    task.cancel()
+            self.metrics.sockets(self.sockets)
+            for sock in self.sockets:
+                sock.close()
+
+        if self.finished:
+            self.on_finished()
+            print("File Transfer Successfully.")
+        else:
+            self.on_failed()
+            print("File Transfer Failed")
+
+class AsyncFileReceiver(FileReceiver):
+    def __init__(self, host: str, port: int, save_path: str, settings=None):
+        super().__init__(host, port, save_path, settings)
+        self.loop = None
+        self.task = None
+        self.pending = None
+
+    def stop(self):
+        self.stop_request = True
+        if self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    async def accept(self, timeout=None):
+        client, client_addr = await asyncio.wait_for(self.loop.sock_accept(self.server), timeout)
+        client.setblocking(False)
+        self.sockets.append(client)
+        print("Client connected: ", client_addr)
+        return client
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        if self.stop_request:
+            return
+        os.makedirs(self.save_path, exist_ok=True)
+
+        try:
+            self.server = listen(self.host, self.port, self.settings)
+        except OSError as error:
+            print("Failed to listen:", error)
+            self.on_failed()
+            return
+        self.server.setblocking(False)
+
+        print("Server listening on {}:{}".format(self.host, self.port))
+
+        try:
+            client = await self.accept()
+        except asyncio.CancelledError:
+            self.server.close()
+            return
+        except OSError as error:
+            self.server.close()
+            print("Failed to accept:", error)
+            self.on_failed()
+            return
+
+        try:
+            await self.serve(client)
+        finally:
+            self.server.close()
+
+    async def serve(self, client):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.client = client
+        if client not in self.sockets:
+            self.sockets.append(client)
+        self.connected = True
+
+        try:
+            await self.receive()
+        except asyncio.CancelledError:
+            # The partial copy and its journal stay for a later resume.
+            self.stop_request = True
+            if self.header is not None and self.batch is not None and not self.complete:
+                self.save_journal()
+            try:
+                await asyncio.wait_for(send_frame(self.loop, client, CANCEL), 1)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            self.on_failed()
+            print("Transfer cancelled")
+        except (OSError, ConnectionError, ProtocolError, struct.error, asyncio.TimeoutError) as error:
+            print("Failed to receive file:", error)
+            self.on_failed()
+        finally:
+            self.metrics.sockets(self.sockets)
+            for sock in self.sockets:
+                sock.close()
+            while self.incoming is not None and not self.incoming.empty():
+                self.incoming.get_nowait()[0].close()
+
+    async def next_frame(self):
+        if self.pending is not None:
+            frame, self.pending = self.pending, None
+            return frame
+        return await recv_frame(self.loop, self.client)
+
+    async def next_stream(self):
+        if self.incoming is None:
+            sock = await self.accept(STREAM_TIMEOUT)
+            return (sock,) + await recv_frame(self.loop, sock)
+        sock, payload = await asyncio.wait_for(self.incoming.get(), STREAM_TIMEOUT)
+        self.sockets.append(sock)
+        return sock, STREAM, payload
+
+    async def open_streams(self, header):
+        streams = {}
+        sock = self.client
+        kind, payload = await recv_frame(self.loop, sock)
+        while True:
+            count = self.add_stream(streams, header, sock, kind, payload)
+            if len(streams) == count:
+                return [streams[index] for index in range(count)]
+            sock, kind, payload = await self.next_stream()
+
+    async def receive_stream(self, sock, disk, offset, size, index, hasher=None):
+        buffer_size = self.flush_size
+        buffer = await disk.take()
+        view = memoryview(buffer)
+        written = self.stream_written(index)
+        filled = 0
+        received = 0
+        last_flush = time.monotonic()
+        reads = writes = wire = 0
+        network = 0.0
+
+        try:
+            while received < size:
+                limit = min(buffer_size, size - received)
+                clock = time.perf_counter()
+                count = await self.loop.sock_recv_into(sock, view[filled:limit])
+                network += time.perf_counter() - clock
+                reads += 1
+                if not count:
+                    break
+                filled += count
+                wire += count
+
+                flush = flush_due(filled, limit, last_flush)
+                if flush is None:
+                    continue
+
+                last_flush = time.monotonic()
+                if flush:
+                    following = await disk.take()
+                    following[:filled - flush] = view[flush:filled]
+                    await disk.write_at(buffer, view[:flush], offset + received, written, hasher)
+                    buffer, view = following, memoryview(following)
+                    writes += 1
+                    filled -= flush
+                    received += flush
+        finally:
+            disk.give(buffer)
+            self.metrics.add(socket_recv_calls=reads, disk_write_calls=writes, network_wait_seconds=network,
+                             bytes_received=wire, payload_bytes=received)
+
+        return received == size
+
+    async def receive_compressed(self, sock, disk, offset, size, index, codec, hasher=None):
+        # Frames are unpacked one at a time in the default executor, the
+        # length of a chunk is only known once it is, and the hash and write
+        # go to the disk queue.
+        written = self.stream_written(index)
+        received = 0
+        frames = wire = 0
+        network = unpacking = 0.0
+        try:
+            while received < size:
+                clock = time.perf_counter()
+                kind, payload = await recv_frame(self.loop, sock)
+                network += time.perf_counter() - clock
+                frames += 1
+                wire += FRAME.size + len(payload)
+                if kind != DATA or not payload:
+                    raise ProtocolError("Expected data frame")
+                clock = time.perf_counter()
+                limit = size - received
+                data = memoryview(await self.loop.run_in_executor(None, codec.unpack, payload[0], memoryview(payload)[1:], limit))
+                unpacking += time.perf_counter() - clock
+                if len(data) > size - received:
+                    raise ProtocolError("Data frame runs past its block")
+                await disk.write_at(None, data, offset + received, written, hasher)
+                received += len(data)
+        finally:
+            self.metrics.add(data_frames=frames, disk_write_calls=frames, network_wait_seconds=network,
+                             decompress_seconds=unpacking, bytes_received=wire, payload_bytes=received)
+        return received == size
+
+    async def receive_ranges(self, sock, ranges, index):
+        hash_name = self.header.hash_name
+        codec = Codec(self.header.codec) if self.header.codec else None
+        try:
+            with (MappedFile if self.settings.maps(self.header.size) else BatchFile)(self.batch, 'r+b') as file:
+                async with AsyncDiskQueue(file, self.settings.pipeline, self.flush_size, self.metrics) as disk:
+                    for offset, count in ranges:
+                        for offset, count in segments(offset, count):
+                            hasher = new_hash(hash_name) if hash_name else None
+                            if codec is not None:
+                                done = await self.receive_compressed(sock, disk, offset, count, index, codec, hasher)
+                            else:
+                                done = await self.receive_stream(sock, disk, offset, count, index, hasher)
+                            if not done:
+                                return
+                            if hasher is not None:
+                                kind, digest = await recv_frame(self.loop, sock)
+                                # Queued behind the writes of the block, which
+                                # hash it on their way to disk.
+                                await disk.submit(self.check_block, hasher, offset, kind, digest)
+                            await disk.submit(self.committed.append, (offset, count))
+        except (OSError, ConnectionError, ProtocolError) as error:
+            print("Stream {} failed: {}".format(index, error))
+
+    async def acknowledge(self):
+        await send_frame(self.loop, self.client, ACK, OFFSET.pack(self.completed))
+        self.meter.update(self.completed)
+        self.on_progress(self.completed)
+
+    async def handshake(self):
+        while True:
+            header, reply = self.handshake_frame(*await self.next_frame())
+            if header is not None:
+                return header
+            if reply is not None:
+                await send_frame(self.loop, self.client, *reply)
+
+    async def receive_manifest(self, header):
+        if header.files is None:
+            return Batch([header], [self.partial_path])
+        kind, payload = await recv_frame(self.loop, self.client)
+        if kind != MANIFEST:
+            raise ProtocolError("Expected manifest frame")
+        return self.manifest_batch(header, payload)
+
+    async def verify(self):
+        if not self.header.hash_name:
+            return True
+        return self.check_trailer(*await recv_frame(self.loop, self.client))
+
+    async def receive(self):
+        with self.metrics.span("handshake"):
+            header = await self.handshake()
+            self.prepare(header)
+            self.batch = await self.receive_manifest(header)
+        with self.metrics.span("allocate"):
+            missing = await self.loop.run_in_executor(None, self.allocate)
+        await send_frame(self.loop, self.client, RANGES, pack_ranges(missing))
+        if header.hash_name:
+            await send_frame(self.loop, self.client, DIGEST, pack_digests(self.digests))
+
+        with self.metrics.span("streams"):
+            streams = await self.open_streams(header)
+        self.stream_received = [0] * len(streams)
+        self.meter.update(self.completed)
+        self.on_connected(header.name, header.size)
+
+        workers = [asyncio.ensure_future(self.receive_ranges(sock, ranges, index)) for index, (sock, ranges) in enumerate(streams)]
+        try:
+            with self.metrics.span("transfer"):
+                last_save = time.monotonic()
+                pending = workers
+                while pending:
+                    _, pending = await asyncio.wait(pending, timeout=ACK_INTERVAL)
+                    await self.acknowledge()
+                    if time.monotonic() - last_save >= JOURNAL_INTERVAL:
+                        await self.loop.run_in_executor(None, self.save_journal)
+                        last_save = time.monotonic()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        with self.metrics.span("verify"):
+            verified = self.complete and await self.verify()
+        if self.complete and not verified:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self.on_failed()
+            print("File failed verification, it will be fetched again")
+        elif self.complete:
+            with self.metrics.span("finish"):
+                await self.loop.run_in_executor(None, self.finish)
+            await self.acknowledge()
+            await send_frame(self.loop, self.client, DONE)
+            self.on_finished()
+            print("File received successfully.")
+        else:
+            await self.loop.run_in_executor(None, self.save_journal)
+            self.on_failed()
+            kept = sum(count for _, count in merge_ranges(self.resumed + self.committed))
+            print("Failed to receive file, kept {} of {} bytes to resume later".format(kept, header.size))
+
+class AsyncReceiverServer(ReceiverServer):
+    # One task per connection, with a semaphore instead of a thread pool, so
+    # hundreds of idle or slow senders cost a coroutine each. New transfers
+    # past the limit wait on the semaphore with their connection open.
+    def __init__(self, host: str, port: int, save_path: str, settings=None, limit=MAX_TRANSFERS):
+        super().__init__(host, port, save_path, settings, limit)
+        self.loop = None
+        self.task = None
+        self.slots = None
+
+    def stop(self):
+        self.stop_request = True
+        if self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        if self.stop_request:
+            return
+        os.makedirs(self.save_path, exist_ok=True)
+
+        try:
+            self.server = listen(self.host, self.port, self.settings)
+        except OSError as error:
+            print("Failed to listen:", error)
+            self.on_error(error)
+            return
+        self.server.setblocking(False)
+        self.slots = asyncio.Semaphore(self.limit)
+
+        print("Server listening on {}:{}, up to {} transfers at once".format(self.host, self.port, self.limit))
+
+        connections = set()
+        try:
+            while True:
+                client, client_addr = await self.loop.sock_accept(self.server)
+                client.setblocking(False)
+                print("Client connected: ", client_addr)
+                task = asyncio.ensure_future(self.dispatch(client))
+                connections.add(task)
+                task.add_done_callback(connections.discard)
+        except asyncio.CancelledError:
+            pass
+        except OSError as error:
+            print("Server stopped:", error)
+            self.on_error(error)
+        finally:
+            self.server.close()
+            for task in list(connections):
+                task.cancel()
+            if connections:
+                await asyncio.wait(connections)
+
+    async def dispatch(self, client):
+        # Without a portable peek on the loop the first frame is read here
+        # and handed to the session along with the connection.
+        try:
+            kind, payload = await asyncio.wait_for(recv_frame(self.loop, client), STREAM_TIMEOUT)
+            if kind == STREAM:
+                transfer_id = unpack_stream(payload)[0]
+                receiver = self.receivers.get(transfer_id)
+                if receiver is None:
+                    raise ProtocolError("Stream for an unknown transfer")
+                receiver.incoming.put_nowait((client, payload))
+                return
+        except (OSError, ConnectionError, ProtocolError, struct.error, asyncio.TimeoutError) as error:
+            print("Dropped connection:", error)
+            client.close()
+            return
+
+        async with self.slots:
+            await self.session(client, (kind, payload))
+
+    def register(self, receiver):
+        for other in self.receivers.values():
+            if other.partial_path == receiver.partial_path:
+                raise ProtocolError("Already receiving {}".format(receiver.header.name))
+        self.receivers[receiver.header.transfer_id] = receiver
+
+    async def session(self, client, frame):
+        self.count += 1
+        number = self.count
+        receiver = AsyncFileReceiver(self.host, self.port, self.save_path, self.settings)
+        receiver.incoming = asyncio.Queue()
+        receiver.pending = frame
+        receiver.on_header = self.register
+        receiver.on_connected = lambda name, size: self.on_started(number, name, size)
+        receiver.on_progress = lambda completed: self.on_progress(number, completed)
+        receiver.on_finished = lambda: self.on_finished(number)
+        receiver.on_failed = lambda: self.on_failed(number)
+
+        self.sessions.add(receiver)
+        try:
+            await receiver.serve(client)
+        finally:
+            self.sessions.discard(receiver)
+            if receiver.header is not None and self.receivers.get(receiver.header.transfer_id) is receiver:
+                del self.receivers[receiver.header.transfer_id]
+            self.on_closed(number, receiver)
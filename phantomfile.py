@@ -0,0 +1,2266 @@
+import os
+import json
+import sys
+import math
+import time
+import lzma
+import queue
+import shutil
+import contextlib
+import collections
+import bisect
+import zlib
+import mmap
+import socket
+import struct
+import hashlib
+import threading
+import concurrent.futures
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CHUNK_SIZE = 1024 * 1024
+SENDFILE_SLICE = 8 * 1024 * 1024
+WRITE_ALIGNMENT = 64 * 1024
+ACK_INTERVAL = 0.1
+
+PROBE_PINGS = 3
+PROBE_SIZE = 256 * 1024
+PROBE_MIN_FILE_SIZE = 4 * 1024 * 1024
+
+PARALLEL_MIN_FILE_SIZE = 64 * 1024 * 1024
+DEFAULT_WINDOW = 4 * 1024 * 1024
+MAX_STREAMS = 8
+STREAM_TIMEOUT = 10
+MAX_TRANSFERS = 4
+JOURNAL_INTERVAL = 1.0
+RATE_WINDOW = 3.0
+RATE_SMOOTHING = 2.0
+HASH_BLOCK = 4 * 1024 * 1024
+PIPELINE_DEPTH = 4
+MAPPED_MIN_FILE_SIZE = 1024 * 1024 * 1024
+MAP_WINDOW = 64 * 1024 * 1024
+COMPRESSION_RATIO = 0.9
+COMPRESSION_RETRY = 64
+COMPRESSION_MAX_BANDWIDTH = 100 * 1024 * 1024
+
+ZERO_COPY = hasattr(os, "sendfile")
+POSITIONAL_WRITE = hasattr(os, "pwrite")
+PREALLOCATE = hasattr(os, "posix_fallocate")
+DATA_SYNC = getattr(os, "fdatasync", os.fsync)
+MADVISE = hasattr(mmap.mmap, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL")
+UNIX = getattr(socket, "AF_UNIX", None)
+
+HEADER = 1
+ACK = 2
+CANCEL = 3
+DONE = 4
+PING = 5
+PONG = 6
+PROBE = 7
+TUNE = 8
+STREAM = 9
+RANGES = 10
+DIGEST = 11
+TRAILER = 12
+DATA = 13
+MANIFEST = 14
+
+RAW = 0
+PACKED = 1
+
+MAGIC = b"PHFL"
+VERSION = 2
+
+HAS_MTIME = 0x01
+HAS_MODE = 0x02
+HAS_HASH = 0x04
+HAS_TRANSFER_ID = 0x08
+HAS_CODEC = 0x10
+HAS_MANIFEST = 0x20
+
+FRAME = struct.Struct("!BI")
+OFFSET = struct.Struct("!Q")
+CHUNK = struct.Struct("!I")
+HEADER_FIELDS = struct.Struct("!4sBBHQ")
+MTIME = struct.Struct("!q")
+MODE = struct.Struct("!I")
+TRANSFER_ID = struct.Struct("!8s")
+STREAM_FIELDS = struct.Struct("!8sHH")
+RANGE = struct.Struct("!QQ")
+# The fixed start of Linux struct tcp_info: eight one byte fields, then
+# rto, ato, ... total_retrans as 32 bit integers.
+TCP_INFO_FIELDS = struct.Struct("8B24I")
+
+# chunk size, socket buffer size (0 leaves the OS autotuning on), TCP_NODELAY,
+# parallel streams (0 picks a count from the measured bandwidth-delay product)
+PROFILES = {
+    "loopback": (4 * 1024 * 1024, 8 * 1024 * 1024, True, 1),
+    "lan": (1024 * 1024, 4 * 1024 * 1024, True, 1),
+    "wan": (256 * 1024, 0, True, 4),
+}
+
+# Any hash needs the bytes in user space, so it turns off the sendfile path.
+# On fast links that costs about a third of the throughput, hashing is off
+# unless asked for.
+HASHES = ["none", "crc32"] + (["xxh3_64"] if xxhash else []) + ["blake2b", "sha256"]
+CODECS = (["zstd"] if zstandard else []) + (["lz4"] if lz4 else []) + ["zlib", "lzma"]
+COMPRESSIONS = ["auto", "none"] + CODECS
+# What a receiver syncs to disk: nothing and leave it to the OS, the files
+# once they are complete, or also the data behind every journal save so a
+# crash never leaves the journal claiming blocks that did not make it.
+DURABILITY = ["none", "end", "periodic"]
+
+# Already compressed formats, sent as they are. Matches what the preview
+# recognises plus the usual audio and archive formats.
+INCOMPRESSIBLE = {
+    "png", "jpg", "jpeg", "gif", "ico", "webp",
+    "mp4", "avi", "mkv", "mov", "webm", "mp3", "aac", "ogg", "flac",
+    "zip", "gz", "bz2", "xz", "zst", "7z", "rar",
+}
+
+class ProtocolError(Exception):
+    pass
+
+class Crc32:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return struct.pack("!I", self.value)
+
+def new_hash(name):
+    if name == "crc32":
+        return Crc32()
+    if name.startswith("xxh"):
+        if xxhash is None:
+            raise ProtocolError("Hash {} needs the xxhash package".format(name))
+        return getattr(xxhash, name)()
+    try:
+        return hashlib.new(name)
+    except ValueError:
+        raise ProtocolError("Unsupported hash {}".format(name))
+
+def root_digest(name, digests):
+    # Whole-file check over the block digests in file order, blocks resumed
+    # from an earlier session included.
+    root = new_hash(name)
+    for _, digest in sorted(digests):
+        root.update(digest)
+    return root.digest()
+
+class Codec:
+    # Compresses chunk by chunk and keeps checking that it pays off. A chunk
+    # that does not shrink below COMPRESSION_RATIO goes out raw and so do the
+    # next COMPRESSION_RETRY chunks, so incompressible data costs one trial
+    # compression every few dozen chunks.
+    def __init__(self, name):
+        # Decompressors stop one byte past the limit, a peer's chunk never
+        # inflates further than that in memory.
+        if name == "zlib":
+            self.compress = lambda data: zlib.compress(data, 1)
+            self.decompress = lambda data, limit: bounded(zlib.decompressobj(), data, limit)
+        elif name == "lzma":
+            self.compress = lambda data: lzma.compress(data, preset=0)
+            self.decompress = lambda data, limit: bounded(lzma.LZMADecompressor(), data, limit)
+        elif name == "zstd" and zstandard:
+            self.compress = zstandard.ZstdCompressor(level=1).compress
+            self.decompress = lambda data, limit: zstandard.ZstdDecompressor().stream_reader(data).read(limit + 1)
+        elif name == "lz4" and lz4:
+            self.compress = lz4.frame.compress
+            self.decompress = lambda data, limit: bounded(lz4.frame.LZ4FrameDecompressor(), data, limit)
+        else:
+            raise ProtocolError("Unsupported compression {}".format(name))
+        self.name = name
+        self.skip = 0
+
+    def pack(self, data):
+        if self.skip:
+            self.skip -= 1
+            return RAW, data
+        packed = self.compress(data)
+        if len(packed) < len(data) * COMPRESSION_RATIO:
+            return PACKED, packed
+        self.skip = COMPRESSION_RETRY
+        return RAW, data
+
+    def unpack(self, flag, data, limit):
+        # Returns at most limit + 1 bytes, the caller checks the chunk against
+        # the room left in its block.
+        if flag == RAW:
+            return data
+        if flag != PACKED:
+            raise ProtocolError("Unknown chunk encoding {}".format(flag))
+        try:
+            return self.decompress(data, limit)
+        except Exception as error:
+            # Every codec library raises its own error type.
+            raise ProtocolError("Corrupt compressed chunk: {}".format(error))
+
+def bounded(decompressor, data, limit):
+    output = decompressor.decompress(data, limit + 1)
+    if len(output) <= limit and not decompressor.eof:
+        raise ValueError("truncated stream")
+    return output
+
+def flush_due(filled, limit, last_flush):
+    # How much of a receive buffer to write out: all of it once full, on slow
+    # links the aligned part every ACK_INTERVAL, otherwise None to go on.
+    if filled == limit:
+        return filled
+    if time.monotonic() - last_flush >= ACK_INTERVAL:
+        return filled - filled % WRITE_ALIGNMENT
+    return None
+
+def segments(offset, count, size=HASH_BLOCK):
+    end = offset + count
+    while offset < end:
+        yield offset, min(size, end - offset)
+        offset += size
+
+class TransferSettings:
+    def __init__(self, profile="auto", chunk_size=CHUNK_SIZE, socket_buffer=0, nodelay=True, streams=0, hash_name="none", compression="auto", trace=False, pipeline=None, mapped=None, durability="none"):
+        self.profile = profile
+        self.chunk_size = chunk_size
+        self.socket_buffer = socket_buffer
+        self.nodelay = nodelay
+        self.streams = streams
+        self.hash_name = None if hash_name == "none" else hash_name
+        self.compression = None if compression == "none" else compression
+        self.trace = trace
+        # Disk reads and writes queued ahead per stream. A single core has no
+        # spare CPU to overlap them with, the thread handoffs only cost there.
+        self.pipeline = pipeline if pipeline is not None else PIPELINE_DEPTH if (os.cpu_count() or 1) > 1 else 0
+        # None maps files from MAPPED_MIN_FILE_SIZE up, True or False forces it.
+        self.mapped = mapped
+        self.durability = durability
+        self.rtt = None
+        self.bandwidth = None
+
+        if profile in PROFILES:
+            self.chunk_size, self.socket_buffer, self.nodelay, self.streams = PROFILES[profile]
+        # A chunk of nothing never advances a read and would spin forever.
+        if self.chunk_size < 1:
+            raise ValueError("Chunk size must be at least 1 byte")
+        if self.socket_buffer < 0 or self.streams < 0 or self.pipeline < 0:
+            raise ValueError("Socket buffer, streams and pipeline depth cannot be negative")
+
+    @property
+    def auto(self):
+        return self.profile == "auto"
+
+    def configure(self, sock, option):
+        if self.nodelay and sock.family != UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not self.socket_buffer:
+            return
+
+        # Linux clamps the request to net.core.[rw]mem_max and switches off
+        # autotuning for the socket, which is worse than not asking at all.
+        limit = "/proc/sys/net/core/{}mem_max".format("w" if option == socket.SO_SNDBUF else "r")
+        try:
+            with open(limit) as file:
+                if int(file.read()) < self.socket_buffer:
+                    return
+        except (OSError, ValueError):
+            pass
+        sock.setsockopt(socket.SOL_SOCKET, option, self.socket_buffer)
+
+    def tune(self, rtt, bandwidth):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        bdp = int(rtt * bandwidth)
+        chunk_size = WRITE_ALIGNMENT
+        while chunk_size < bdp // 4 and chunk_size < 4 * 1024 * 1024:
+            chunk_size *= 2
+        self.chunk_size = chunk_size
+        self.socket_buffer = min(max(2 * bdp, 256 * 1024), 32 * 1024 * 1024)
+        print("Measured RTT {:.2f} ms, bandwidth {:.1f} MB/s".format(rtt * 1000, bandwidth / 1e6))
+
+    def stream_count(self, size):
+        if size < PARALLEL_MIN_FILE_SIZE:
+            return 1
+        if self.streams:
+            return self.streams
+        if self.rtt is None:
+            return 1
+
+        # One stream is capped by its window, so open as many as it takes to
+        # cover the bandwidth-delay product.
+        window = self.socket_buffer or DEFAULT_WINDOW
+        return max(1, min(MAX_STREAMS, -(-int(self.rtt * self.bandwidth) // window)))
+
+    def maps(self, size):
+        if self.mapped is not None:
+            return self.mapped
+        return size >= MAPPED_MIN_FILE_SIZE
+
+    def codec_for(self, name):
+        if not self.compression:
+            return None
+        if os.path.splitext(name)[1][1:].lower() in INCOMPRESSIBLE:
+            return None
+        if self.compression != "auto":
+            return self.compression
+
+        # Compression only pays off while the link is slower than the codec.
+        # A link that was not measured is only taken for slow on the wan
+        # profile, elsewhere it would cost the sendfile path for nothing.
+        if self.bandwidth is None:
+            return CODECS[0] if self.profile == "wan" else None
+        if self.bandwidth > COMPRESSION_MAX_BANDWIDTH:
+            return None
+        return CODECS[0]
+
+class FileHeader:
+    # Wire layout: magic, version, flags, name length and size, then the
+    # UTF-8 name followed by the optional fields announced in flags, in flag
+    # order. Fields added by newer flags go after the known ones so an older
+    # reader can ignore them.
+    def __init__(self, name: str, size: int, mtime=None, mode=None, hash_name=None, digest=None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.hash_name = hash_name
+        self.digest = digest
+        self.transfer_id = None
+        self.codec = None
+        self.files = None
+
+    @classmethod
+    def from_path(cls, file_path):
+        stat = os.stat(file_path)
+        return cls(os.path.basename(file_path), stat.st_size, stat.st_mtime_ns, stat.st_mode & 0o7777)
+
+    @property
+    def flags(self):
+        flags = 0
+        if self.mtime is not None:
+            flags |= HAS_MTIME
+        if self.mode is not None:
+            flags |= HAS_MODE
+        if self.digest is not None:
+            flags |= HAS_HASH
+        if self.transfer_id is not None:
+            flags |= HAS_TRANSFER_ID
+        if self.codec is not None:
+            flags |= HAS_CODEC
+        if self.files is not None:
+            flags |= HAS_MANIFEST
+        return flags
+
+    def pack(self):
+        name = self.name.encode()
+        if len(name) > 0xFFFF:
+            raise ProtocolError("File name too long")
+
+        data = HEADER_FIELDS.pack(MAGIC, VERSION, self.flags, len(name), self.size) + name
+        if self.mtime is not None:
+            data += MTIME.pack(self.mtime)
+        if self.mode is not None:
+            data += MODE.pack(self.mode)
+        if self.digest is not None:
+            hash_name = self.hash_name.encode()
+            data += bytes([len(hash_name)]) + hash_name + bytes([len(self.digest)]) + self.digest
+        if self.transfer_id is not None:
+            data += TRANSFER_ID.pack(self.transfer_id)
+        if self.codec is not None:
+            codec = self.codec.encode()
+            data += bytes([len(codec)]) + codec
+        if self.files is not None:
+            data += CHUNK.pack(self.files)
+        return data
+
+    @classmethod
+    def unpack(cls, data):
+        try:
+            magic, version, flags, name_length, size = HEADER_FIELDS.unpack_from(data)
+            if magic != MAGIC:
+                raise ProtocolError("Not a Phantom File header")
+            if version != VERSION:
+                raise ProtocolError("Unsupported protocol version {}".format(version))
+
+            offset = HEADER_FIELDS.size
+            header = cls(data[offset:offset + name_length].decode(), size)
+            offset += name_length
+
+            if flags & HAS_MTIME:
+                (header.mtime,) = MTIME.unpack_from(data, offset)
+                offset += MTIME.size
+            if flags & HAS_MODE:
+                (header.mode,) = MODE.unpack_from(data, offset)
+                offset += MODE.size
+            if flags & HAS_HASH:
+                length = data[offset]
+                header.hash_name = data[offset + 1:offset + 1 + length].decode()
+                offset += 1 + length
+                length = data[offset]
+                header.digest = bytes(data[offset + 1:offset + 1 + length])
+                offset += 1 + length
+            if flags & HAS_TRANSFER_ID:
+                (header.transfer_id,) = TRANSFER_ID.unpack_from(data, offset)
+                offset += TRANSFER_ID.size
+            if flags & HAS_CODEC:
+                length = data[offset]
+                header.codec = data[offset + 1:offset + 1 + length].decode()
+                offset += 1 + length
+            if flags & HAS_MANIFEST:
+                (header.files,) = CHUNK.unpack_from(data, offset)
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise ProtocolError("Malformed header")
+        return header
+
+    def apply(self, file_path):
+        if self.mode is not None and os.name == "posix":
+            os.chmod(file_path, self.mode & 0o777)
+        if self.mtime is not None:
+            os.utime(file_path, ns=(time.time_ns(), self.mtime))
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+def send_frame(sock, kind, payload=b""):
+    sock.sendall(FRAME.pack(kind, len(payload)) + payload)
+
+def recv_frame(sock):
+    kind, length = FRAME.unpack(recv_exact(sock, FRAME.size))
+    return kind, recv_exact(sock, length)
+
+def write_all(file, view):
+    while view:
+        view = view[file.write(view):]
+
+def write_at(file, view, offset):
+    if not POSITIONAL_WRITE:
+        file.seek(offset)
+        write_all(file, view)
+        return
+    while view:
+        written = os.pwrite(file.fileno(), view, offset)
+        view = view[written:]
+        offset += written
+
+def preallocate(file, size):
+    # Reserves the blocks up front so a large file lands in a few extents
+    # instead of growing chunk by chunk. Filesystems that cannot do it keep
+    # the sparse file.
+    file.truncate(size)
+    if PREALLOCATE and size:
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+        except OSError:
+            pass
+
+def sync_path(path, data_only=True):
+    # Windows flushes with FlushFileBuffers, which needs write access. Only
+    # folders are opened read-only, and only POSIX can sync those.
+    fd = os.open(path, os.O_RDONLY if os.path.isdir(path) else os.O_RDWR)
+    try:
+        (DATA_SYNC if data_only else os.fsync)(fd)
+    finally:
+        os.close(fd)
+
+def merge_ranges(ranges):
+    merged = []
+    for offset, count in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            start = merged[-1][0]
+            merged[-1] = (start, max(merged[-1][1], offset + count - start))
+        elif count:
+            merged.append((offset, count))
+    return merged
+
+def missing_ranges(done, size):
+    missing = []
+    position = 0
+    for offset, count in merge_ranges(done):
+        if offset > position:
+            missing.append((position, offset - position))
+        position = max(position, offset + count)
+    if position < size:
+        missing.append((position, size - position))
+    return missing
+
+def split_ranges(ranges, count):
+    # Deals the ranges out to count streams in contiguous, aligned pieces of
+    # roughly equal size. Streams that end up with nothing are dropped.
+    total = sum(size for _, size in ranges)
+    step = -(-total // max(1, count))
+    step += -step % WRITE_ALIGNMENT
+    streams = [[]]
+    space = step
+    for offset, size in ranges:
+        while size:
+            if not space:
+                streams.append([])
+                space = step
+            piece = min(size, space)
+            streams[-1].append((offset, piece))
+            offset += piece
+            size -= piece
+            space -= piece
+    return streams
+
+def pack_ranges(ranges):
+    return b"".join(RANGE.pack(*item) for item in ranges)
+
+def unpack_ranges(payload, offset=0):
+    return [RANGE.unpack_from(payload, position) for position in range(offset, len(payload), RANGE.size)]
+
+def pack_digests(digests):
+    return b"".join(OFFSET.pack(offset) + digest for offset, digest in digests)
+
+def unpack_digests(payload, size):
+    # Digests of one hash all have the same size.
+    step = OFFSET.size + size
+    if len(payload) % step:
+        raise ProtocolError("Malformed digest list")
+    return [(OFFSET.unpack_from(payload, position)[0], payload[position + OFFSET.size:position + step])
+            for position in range(0, len(payload), step)]
+
+def pack_stream(transfer_id, index, count, ranges):
+    return STREAM_FIELDS.pack(transfer_id, index, count) + pack_ranges(ranges)
+
+def unpack_stream(payload):
+    transfer_id, index, count = STREAM_FIELDS.unpack_from(payload)
+    return transfer_id, index, count, unpack_ranges(payload, STREAM_FIELDS.size)
+
+def pack_manifest(members):
+    return b"".join(CHUNK.pack(len(data)) + data for data in (member.pack() for member in members))
+
+def unpack_manifest(payload):
+    members = []
+    offset = 0
+    try:
+        while offset < len(payload):
+            (length,) = CHUNK.unpack_from(payload, offset)
+            offset += CHUNK.size
+            members.append(FileHeader.unpack(payload[offset:offset + length]))
+            offset += length
+    except struct.error:
+        raise ProtocolError("Malformed manifest")
+    return members
+
+def member_path(root, name):
+    # Manifest names are relative and "/" separated. Anything that could
+    # climb out of the save folder is refused.
+    parts = name.split("/")
+    for part in parts:
+        if part in ("", ".", "..") or os.sep in part or (os.altsep and os.altsep in part) or os.path.splitdrive(part)[0]:
+            raise ProtocolError("Unsafe file name {!r} in manifest".format(name))
+    return os.path.join(root, *parts)
+
+def unique_name(name, taken):
+    root, extension = os.path.splitext(name)
+    number = 2
+    while name in taken:
+        name = "{} ({}){}".format(root, number, extension)
+        number += 1
+    taken.add(name)
+    return name
+
+class Batch:
+    # The files of one transfer laid end to end as a single payload. Ranges,
+    # blocks, digests and the journal all work on payload offsets, so a folder
+    # streams like one big file and small files share chunks instead of each
+    # paying for a connection. A lone file is a batch of one without a name.
+    def __init__(self, members, paths, name=None):
+        self.members = members
+        self.paths = paths
+        self.name = name
+        self.starts = []
+        self.size = 0
+        for member in members:
+            self.starts.append(self.size)
+            self.size += member.size
+
+    @classmethod
+    def from_paths(cls, paths):
+        if len(paths) == 1 and not os.path.isdir(paths[0]):
+            return cls([FileHeader.from_path(paths[0])], [paths[0]])
+
+        members = []
+        sources = []
+        taken = set()
+        for path in paths:
+            path = os.path.abspath(path)
+            if not os.path.isdir(path):
+                files = [path]
+                base = os.path.dirname(path)
+            else:
+                # A lone folder becomes the batch itself, folders picked
+                # alongside other paths keep their name as a prefix.
+                files = []
+                base = path if len(paths) == 1 else os.path.dirname(path)
+                for folder, folders, names in os.walk(path):
+                    folders.sort()
+                    files += [os.path.join(folder, name) for name in sorted(names)]
+
+            for source in files:
+                if not os.path.isfile(source):
+                    continue
+                member = FileHeader.from_path(source)
+                member.name = unique_name(os.path.relpath(source, base).replace(os.sep, "/"), taken)
+                members.append(member)
+                sources.append(source)
+
+        if len(paths) == 1:
+            name = os.path.basename(os.path.abspath(paths[0]))
+        else:
+            name = "{} files".format(len(members))
+        return cls(members, sources, name)
+
+    def header(self):
+        if self.name is None:
+            return self.members[0]
+        header = FileHeader(self.name, self.size, max((member.mtime for member in self.members), default=None))
+        header.files = len(self.members)
+        return header
+
+    def locate(self, offset):
+        return max(0, bisect.bisect_right(self.starts, offset) - 1)
+
+    def pieces(self, offset, count):
+        index = self.locate(offset)
+        end = offset + count
+        while offset < end and index < len(self.members):
+            member_offset = offset - self.starts[index]
+            size = min(self.members[index].size - member_offset, end - offset)
+            if size > 0:
+                yield index, member_offset, size
+                offset += size
+            index += 1
+
+class BatchFile:
+    # Positional reads and writes across the members of a batch. Only one
+    # member is held open at a time; a stream walks its ranges in order, so
+    # that is all the caching thousands of small files need.
+    mapped = False
+
+    def __init__(self, batch, mode):
+        self.batch = batch
+        self.mode = mode
+        self.index = None
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.index = None
+
+    def member(self, index):
+        if index != self.index:
+            self.close()
+            self.file = open(self.batch.paths[index], self.mode, buffering=0)
+            self.index = index
+        return self.file
+
+    def read_at(self, view, offset):
+        done = 0
+        for index, member_offset, size in self.batch.pieces(offset, len(view)):
+            file = self.member(index)
+            file.seek(member_offset)
+            count = file.readinto(view[done:done + size])
+            done += count
+            if count < size:
+                break
+        return done
+
+    def write_at(self, view, offset):
+        done = 0
+        for index, member_offset, size in self.batch.pieces(offset, len(view)):
+            write_at(self.member(index), view[done:done + size], member_offset)
+            done += size
+
+    def sendfile(self, sock, offset, count):
+        for index, member_offset, size in self.batch.pieces(offset, count):
+            return sock.sendfile(self.member(index), member_offset, size)
+        return 0
+
+class MappedFile(BatchFile):
+    # A BatchFile that goes through a memory map instead of read and write
+    # calls. Only a window of one member is mapped at a time and a stream
+    # walks its ranges in order, so RSS stays bounded however large the file
+    # is. Sequential advice lets the kernel read ahead and drop pages behind.
+    mapped = True
+
+    def __init__(self, batch, mode, window=MAP_WINDOW):
+        super().__init__(batch, mode)
+        self.window = window - window % mmap.ALLOCATIONGRANULARITY
+        self.map = None
+        self.view = None
+        self.start = self.end = 0
+        self.exported = []
+
+    def close(self):
+        self.unmap()
+        super().close()
+
+    def unmap(self):
+        if self.map is None:
+            return
+        for view in self.exported:
+            view.release()
+        self.exported = []
+        self.view.release()
+        self.map.close()
+        self.map = self.view = None
+
+    def mapping(self, index, offset):
+        # Returns the mapped view and the member offset it starts at.
+        if index != self.index or not self.start <= offset < self.end:
+            file = self.member(index)
+            self.unmap()
+            size = self.batch.members[index].size
+            self.start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            self.end = min(size, self.start + self.window)
+            # Mapping past the end of a file that shrank since it was
+            # announced raises ValueError, the buffered path's EOFError
+            # is what the streams handle.
+            if os.fstat(file.fileno()).st_size < self.end:
+                raise EOFError("File is shorter than announced")
+            access = mmap.ACCESS_READ if self.mode == 'rb' else mmap.ACCESS_WRITE
+            self.map = mmap.mmap(file.fileno(), self.end - self.start, access=access, offset=self.start)
+            if MADVISE:
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+            self.view = memoryview(self.map)
+        return self.view, self.start
+
+    def parts(self, offset, count):
+        # Yields views straight into the mapping, each within one window.
+        for index, member_offset, size in self.batch.pieces(offset, count):
+            end = member_offset + size
+            while member_offset < end:
+                view, start = self.mapping(index, member_offset)
+                part = view[member_offset - start:min(end, self.end) - start]
+                # Views must be gone before the window moves, unmap releases
+                # them in case the caller still holds one.
+                self.exported.append(part)
+                member_offset += len(part)
+                yield part
+                part.release()
+                self.exported.remove(part)
+
+    def read_at(self, view, offset):
+        done = 0
+        for part in self.parts(offset, len(view)):
+            size = len(part)
+            view[done:done + size] = part
+            done += size
+        return done
+
+    def write_at(self, view, offset):
+        done = 0
+        for part in self.parts(offset, len(view)):
+            size = len(part)
+            part[:] = view[done:done + size]
+            done += size
+
+    def slices(self, offset, end, chunk_size):
+        # Chunks of the range as views of the mapping, no copy in user space.
+        while offset < end:
+            for part in self.parts(offset, min(chunk_size, end - offset)):
+                offset += len(part)
+                yield part
+
+class DiskQueue:
+    # Moves the disk I/O of one stream to a helper thread so it overlaps the
+    # socket I/O of the stream's own thread. Jobs run one at a time in the
+    # order they were queued, so a commit queued behind the writes of a block
+    # only runs once they are on disk. At most depth jobs are in flight with
+    # one more buffer being filled, and the stream thread waits on the oldest
+    # job once they are all taken; that wait is the backpressure that keeps
+    # memory bounded. A depth of 0 runs every job inline.
+    def __init__(self, file, depth, size, metrics):
+        self.file = file
+        self.depth = depth
+        # A mapping is read and written in place and needs no buffers.
+        self.free = [] if file.mapped else [bytearray(size) for _ in range(max(depth + 1, 2))]
+        self.pending = collections.deque()
+        self.metrics = metrics
+        self.error = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(1) if depth else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def result(self, future):
+        clock = time.perf_counter()
+        try:
+            return future.result()
+        finally:
+            self.metrics.add(disk_wait_seconds=time.perf_counter() - clock)
+
+    def wait(self):
+        future, buffer = self.pending.popleft()
+        try:
+            self.result(future)
+        finally:
+            if buffer is not None:
+                self.free.append(buffer)
+
+    def take(self):
+        while not self.free:
+            self.wait()
+        return self.free.pop()
+
+    def give(self, buffer):
+        self.free.append(buffer)
+
+    def call(self, function, *args):
+        # After a failed job the rest are skipped, a commit must never run
+        # behind a write that did not make it.
+        if self.error is not None:
+            raise self.error
+        try:
+            return function(*args)
+        except BaseException as error:
+            self.error = error
+            raise
+
+    def start(self, function, *args):
+        if self.executor is not None:
+            return self.executor.submit(self.call, function, *args)
+        future = concurrent.futures.Future()
+        clock = time.perf_counter()
+        try:
+            future.set_result(self.call(function, *args))
+        except BaseException as error:
+            future.set_exception(error)
+        self.metrics.add(disk_wait_seconds=time.perf_counter() - clock)
+        return future
+
+    def submit(self, function, *args, buffer=None):
+        # buffer goes back to the pool once the job is done with it.
+        while self.pending and len(self.pending) >= self.depth:
+            self.wait()
+        self.pending.append((self.start(function, *args), buffer))
+
+    def write_at(self, buffer, view, offset, then=None):
+        def write():
+            self.file.write_at(view, offset)
+            if then is not None:
+                then(len(view))
+        self.submit(write, buffer=buffer)
+
+    def read_ahead(self, offset, end, chunk_size):
+        # Yields the range chunk by chunk with up to depth reads running ahead.
+        # A yielded view is only valid until the next one is asked for. A
+        # mapping needs no buffers, the kernel reads ahead for it.
+        if self.file.mapped:
+            yield from self.file.slices(offset, end, chunk_size)
+            return
+        reads = collections.deque()
+        held = None
+        try:
+            while reads or offset < end:
+                while self.free and offset < end:
+                    buffer = self.free.pop()
+                    view = memoryview(buffer)[:min(chunk_size, end - offset)]
+                    reads.append((self.start(self.file.read_at, view, offset), buffer, view))
+                    offset += len(view)
+                future, held, view = reads.popleft()
+                if self.result(future) < len(view):
+                    raise EOFError("File is shorter than announced")
+                yield view
+                self.free.append(held)
+                held = None
+        finally:
+            # Reads still in flight own their buffers until they return.
+            for future, buffer, _ in reads:
+                concurrent.futures.wait([future])
+                self.free.append(buffer)
+            if held is not None:
+                self.free.append(held)
+
+    def close(self):
+        try:
+            while self.pending:
+                self.wait()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+def shutdown(sock, how=socket.SHUT_RDWR):
+    try:
+        sock.shutdown(how)
+    except OSError:
+        pass
+
+def endpoint(host, port):
+    # A socket path in place of the host selects a Unix domain socket, which
+    # skips the TCP stack for transfers on the same machine.
+    if UNIX and host.startswith("/"):
+        return UNIX, host
+    return socket.AF_INET, (host, port)
+
+def listen(host, port, settings):
+    family, address = endpoint(host, port)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    settings.configure(server, socket.SO_RCVBUF)
+    if family == UNIX and os.path.exists(address):
+        os.unlink(address)
+    elif family != UNIX and os.name == "posix":
+        # The accepted socket of the last transfer lingers in TIME_WAIT on
+        # this port, without this the next receive could not bind it.
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address)
+    server.listen()
+    return server
+
+class Progress:
+    # Latest byte count of a transfer, shared with whoever displays it. The
+    # transfer only stores the number, an int assignment is atomic under the
+    # GIL and never waits on the reader, which samples it on its own timer.
+    def __init__(self):
+        self.value = 0
+        self.sampled = 0
+
+    def update(self, value):
+        self.value = value
+
+    def sample(self):
+        # Returns None while nothing changed, so idle ticks cost nothing.
+        value = self.value
+        if value == self.sampled:
+            return None
+        self.sampled = value
+        return value
+
+class RateMeter:
+    # Transfer rate from timestamped byte counts rather than from the number
+    # of updates, so late or bunched progress reports do not skew it. The
+    # current rate is the slope over the last RATE_WINDOW seconds up to now,
+    # which falls off while the transfer stalls. The ETA uses an EWMA whose
+    # weight grows with the time since the previous sample.
+    def __init__(self, window=RATE_WINDOW, smoothing=RATE_SMOOTHING):
+        self.window = window
+        self.smoothing = smoothing
+        self.samples = collections.deque()
+        self.started = None
+        self.smoothed = 0.0
+        self.peak = 0.0
+
+    def update(self, done, now=None):
+        now = time.monotonic() if now is None else now
+        if self.started is None:
+            self.started = (now, done)
+            self.samples.append((now, done))
+            return
+
+        last_time, last_done = self.samples[-1]
+        elapsed = now - last_time
+        if elapsed <= 0:
+            return
+        rate = (done - last_done) / elapsed
+        if len(self.samples) == 1:
+            self.smoothed = rate
+        else:
+            self.smoothed += (1 - math.exp(-elapsed / self.smoothing)) * (rate - self.smoothed)
+
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        # A window that has barely started is too short to set the peak.
+        if now - self.samples[0][0] >= self.window / 2:
+            self.peak = max(self.peak, self.current(now))
+
+    @property
+    def done(self):
+        return self.samples[-1][1] if self.samples else 0
+
+    def current(self, now=None):
+        if not self.samples:
+            return 0.0
+        first_time, first_done = self.samples[0]
+        last_time, last_done = self.samples[-1]
+        elapsed = max(time.monotonic() if now is None else now, last_time) - first_time
+        return (last_done - first_done) / elapsed if elapsed > 0 else 0.0
+
+    def average(self):
+        if not self.samples:
+            return 0.0
+        (start_time, start_done), (last_time, last_done) = self.started, self.samples[-1]
+        elapsed = last_time - start_time
+        return (last_done - start_done) / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, total):
+        # Seconds left, None until there is a rate to go by.
+        if self.smoothed <= 0:
+            return None
+        return max(total - self.done, 0) / self.smoothed
+
+def tcp_info(sock):
+    # Linux only. Retransmissions and the kernel's RTT estimate tell a lossy
+    # or congested path apart from a slow disk, which byte counts cannot.
+    if not hasattr(socket, "TCP_INFO") or sock.family == UNIX:
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_FIELDS.size)
+        fields = TCP_INFO_FIELDS.unpack(info)
+    except (OSError, struct.error):
+        return None
+    return {
+        "lost": fields[14],
+        "rtt": fields[23] / 1e6,
+        "rttvar": fields[24] / 1e6,
+        "snd_cwnd": fields[26],
+        "retransmits": fields[31],
+    }
+
+class Metrics:
+    # Counters and timing spans of one transfer. Hot loops total their
+    # numbers locally and hand them over once per block, so the lock is taken
+    # a few times per megabyte. disk_wait_seconds and network_wait_seconds
+    # are the time spent blocked in file and socket calls, the larger one is
+    # what a slow transfer waits on. Spans are only kept with trace on.
+    def __init__(self, trace=False):
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.spans = [] if trace else None
+        self.origin = time.perf_counter()
+        self.created = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, **counters):
+        with self.lock:
+            self.counters.update(counters)
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.counters[name + "_seconds"] += elapsed
+                if self.spans is not None:
+                    self.spans.append({"name": name, "start": start - self.origin, "duration": elapsed,
+                                       "thread": threading.current_thread().name})
+
+    def sockets(self, sockets):
+        # Read just before the sockets close, the kernel drops it afterwards.
+        infos = [info for info in map(tcp_info, sockets) if info is not None]
+        if not infos:
+            return
+        self.add(tcp_retransmits=sum(info["retransmits"] for info in infos),
+                 tcp_lost=sum(info["lost"] for info in infos))
+        self.gauge("tcp_rtt_seconds", max(info["rtt"] for info in infos))
+        self.gauge("tcp_rttvar_seconds", max(info["rttvar"] for info in infos))
+        self.gauge("tcp_snd_cwnd", max(info["snd_cwnd"] for info in infos))
+
+    def snapshot(self, **labels):
+        with self.lock:
+            record = {"time": self.created, "labels": labels, "counters": dict(self.counters), "gauges": dict(self.gauges)}
+            if self.spans is not None:
+                record["spans"] = list(self.spans)
+        return record
+
+    def merge(self, other):
+        # Totals across transfers, gauges keep the latest transfer's value.
+        record = other.snapshot()
+        with self.lock:
+            self.counters.update(record["counters"])
+            self.gauges.update(record["gauges"])
+
+    def prometheus(self, **labels):
+        record = self.snapshot(**labels)
+        selector = ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                            for key, value in sorted(labels.items()))
+        lines = []
+        for kind, suffix, values in (("counter", "_total", record["counters"]), ("gauge", "", record["gauges"])):
+            for name, value in sorted(values.items()):
+                name = "phantomfile_" + name + suffix
+                lines.append("# TYPE {} {}".format(name, kind))
+                lines.append("{}{{{}}} {}".format(name, selector, value))
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, **labels):
+        # Files ending in .prom are rewritten in the Prometheus text format
+        # for the node exporter's textfile collector, anything else gets one
+        # JSON line appended per transfer.
+        if path.endswith(".prom"):
+            with open(path + ".tmp", "w") as file:
+                file.write(self.prometheus(**labels))
+            os.replace(path + ".tmp", path)
+        else:
+            with open(path, "a") as file:
+                file.write(json.dumps(self.snapshot(**labels)) + "\n")
+
+def _noop(*args):
+    pass
+
+class FileSender:
+    # Streams the file without waiting for the receiver. Large files are split
+    # into byte ranges sent over parallel connections; every data connection
+    # starts with a STREAM frame naming its ranges. The receiver answers on
+    # the first connection with periodic ACK frames carrying the bytes it has
+    # written, followed by DONE once the whole file is on disk or CANCEL when
+    # the user aborts on that side. file_path may also be a folder or a list
+    # of files and folders, which go out as one batch behind a MANIFEST frame.
+    def __init__(self, host: str, port: int, file_path, settings=None):
+        self.host = host
+        self.port = port
+        self.file_path = file_path
+        self.settings = settings or TransferSettings()
+        self.stop_request = False
+        self.cancelled = False
+        self.finished = False
+        self.zero_copy = ZERO_COPY
+        self.acknowledged = 0
+        self.sent = []
+        self.digests = []
+        self.codec = None
+        self.batch = None
+        self.header = None
+        self.client = None
+        self.sockets = []
+        self.meter = RateMeter()
+        self.metrics = Metrics(self.settings.trace)
+
+        self.on_connected = _noop
+        self.on_progress = _noop
+        self.on_failed = _noop
+        self.on_finished = _noop
+
+    def stop(self):
+        self.stop_request = True
+        for sock in self.sockets:
+            shutdown(sock)
+
+    def connect(self):
+        while not self.stop_request:
+            family, address = endpoint(self.host, self.port)
+            client = socket.socket(family, socket.SOCK_STREAM)
+            self.settings.configure(client, socket.SO_SNDBUF)
+            try:
+                client.connect(address)
+                self.sockets.append(client)
+                return client
+            except (ConnectionRefusedError, FileNotFoundError):
+                client.close()
+                print("Connection refused. Retrying in 2 seconds...")
+                time.sleep(2)
+        return None
+
+    def measure(self):
+        rtt = float("inf")
+        for index in range(PROBE_PINGS):
+            start = time.perf_counter()
+            send_frame(self.client, PING, OFFSET.pack(index))
+            if recv_frame(self.client)[0] != PONG:
+                raise ProtocolError("Expected pong frame")
+            rtt = min(rtt, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        send_frame(self.client, PROBE, bytes(PROBE_SIZE))
+        if recv_frame(self.client)[0] != ACK:
+            raise ProtocolError("Expected probe acknowledgement")
+        elapsed = time.perf_counter() - start
+        return rtt, PROBE_SIZE / max(elapsed - rtt, rtt, 1e-6)
+
+    def handshake(self, header):
+        if self.settings.auto and header.size >= PROBE_MIN_FILE_SIZE:
+            self.settings.tune(*self.measure())
+            self.settings.configure(self.client, socket.SO_SNDBUF)
+            send_frame(self.client, TUNE, CHUNK.pack(self.settings.chunk_size))
+
+        self.announce(header)
+        send_frame(self.client, HEADER, header.pack())
+        if header.files is not None:
+            send_frame(self.client, MANIFEST, pack_manifest(self.batch.members))
+
+        # The receiver answers with the ranges it is still missing, which is
+        # the whole file unless it holds a partial copy from an earlier try.
+        kind, payload = recv_frame(self.client)
+        if kind != RANGES:
+            raise ProtocolError("Expected missing ranges")
+        streams = self.plan(header, payload)
+        if self.settings.hash_name:
+            kind, payload = recv_frame(self.client)
+            self.resume_digests(header, kind, payload)
+        return streams
+
+    def announce(self, header):
+        header.transfer_id = os.urandom(8)
+        if self.settings.hash_name:
+            # Only the algorithm is announced, the digests follow the data.
+            header.hash_name = self.settings.hash_name
+            header.digest = b""
+        self.codec = header.codec = self.settings.codec_for(header.name)
+        if self.codec:
+            print("Compressing with {}".format(self.codec))
+
+    def plan(self, header, payload):
+        missing = unpack_ranges(payload)
+        if any(offset + count > header.size for offset, count in missing):
+            raise ProtocolError("Requested range outside of the file")
+
+        remaining = sum(count for _, count in missing)
+        # What the receiver already holds counts as acknowledged.
+        self.acknowledged = header.size - remaining
+        if remaining < header.size:
+            print("Resuming transfer, {} of {} bytes left".format(remaining, header.size))
+        return split_ranges(missing, self.settings.stream_count(remaining))
+
+    def resume_digests(self, header, kind, payload):
+        # Digests of the blocks the receiver already holds, they go into the
+        # root digest next to the ones sent now.
+        if kind != DIGEST:
+            raise ProtocolError("Expected digests of resumed blocks")
+        self.digests = unpack_digests(payload, len(new_hash(header.hash_name).digest()))
+        if any(offset >= header.size for offset, _ in self.digests):
+            raise ProtocolError("Digest outside of the file")
+
+    def read_control(self):
+        try:
+            while True:
+                kind, payload = recv_frame(self.client)
+                if kind == ACK:
+                    (self.acknowledged,) = OFFSET.unpack(payload)
+                    self.meter.update(self.acknowledged)
+                    self.on_progress(self.acknowledged)
+                elif kind == DONE:
+                    self.finished = True
+                    return
+                elif kind == CANCEL:
+                    self.cancelled = True
+                    return
+        except (OSError, ConnectionError, struct.error):
+            return
+
+    def send_zero_copy(self, sock, file, offset, count, index):
+        # The kernel copies straight from the page cache into the socket. It
+        # is sliced so a stop request is noticed between slices.
+        start, end = offset, offset + count
+        calls = 0
+        clock = time.perf_counter()
+        try:
+            while offset < end and not self.stop_request and not self.cancelled:
+                sent = file.sendfile(sock, offset, min(SENDFILE_SLICE, end - offset))
+                calls += 1
+                if sent == 0:
+                    raise EOFError("File is shorter than announced")
+                offset += sent
+                self.sent[index] += sent
+        finally:
+            # The disk and network share one call here and cannot be told apart.
+            self.metrics.add(sendfile_calls=calls, sendfile_seconds=time.perf_counter() - clock,
+                             bytes_sent=offset - start, payload_bytes=offset - start)
+
+    def send_buffered(self, sock, disk, offset, count, index, hasher=None):
+        # Reads run ahead on the disk queue while this thread sends.
+        start = offset
+        calls = 0
+        network = hashing = 0.0
+        try:
+            for view in disk.read_ahead(offset, offset + count, self.settings.chunk_size):
+                if self.stop_request or self.cancelled:
+                    break
+                if hasher is not None:
+                    clock = time.perf_counter()
+                    hasher.update(view)
+                    hashing += time.perf_counter() - clock
+                clock = time.perf_counter()
+                sock.sendall(view)
+                network += time.perf_counter() - clock
+                calls += 1
+                offset += len(view)
+                self.sent[index] += len(view)
+        finally:
+            self.metrics.add(disk_read_calls=calls, socket_send_calls=calls, network_wait_seconds=network,
+                             hash_seconds=hashing, bytes_sent=offset - start, payload_bytes=offset - start)
+
+    def send_compressed(self, sock, disk, offset, count, index, codec, hasher=None):
+        # Every chunk becomes a DATA frame flagged raw or packed, the receiver
+        # counts the decompressed bytes against the block.
+        start = offset
+        calls = wire = 0
+        network = hashing = packing = 0.0
+        try:
+            for view in disk.read_ahead(offset, offset + count, self.settings.chunk_size):
+                if self.stop_request or self.cancelled:
+                    break
+                if hasher is not None:
+                    clock = time.perf_counter()
+                    hasher.update(view)
+                    hashing += time.perf_counter() - clock
+                clock = time.perf_counter()
+                flag, data = codec.pack(view)
+                frame = b"".join((FRAME.pack(DATA, 1 + len(data)), bytes([flag]), data))
+                packing += time.perf_counter() - clock
+                clock = time.perf_counter()
+                sock.sendall(frame)
+                network += time.perf_counter() - clock
+                calls += 1
+                wire += len(frame)
+                offset += len(view)
+                self.sent[index] += len(view)
+        finally:
+            self.metrics.add(disk_read_calls=calls, socket_send_calls=calls, network_wait_seconds=network,
+                             hash_seconds=hashing, compress_seconds=packing, bytes_sent=wire,
+                             payload_bytes=offset - start)
+
+    def send_blocks(self, sock, disk, offset, count, index, codec=None):
+        # Hashing and compression need the bytes in user space, so this path
+        # trades the zero-copy send for a digest frame after every block.
+        hash_name = self.settings.hash_name
+        for offset, count in segments(offset, count):
+            hasher = new_hash(hash_name) if hash_name else None
+            if codec is not None:
+                self.send_compressed(sock, disk, offset, count, index, codec, hasher)
+            else:
+                self.send_buffered(sock, disk, offset, count, index, hasher)
+            if self.stop_request or self.cancelled:
+                return
+            if hasher is not None:
+                digest = hasher.digest()
+                send_frame(sock, DIGEST, digest)
+                self.digests.append((offset, digest))
+
+    def send_stream(self, sock, transfer_id, index, count, ranges):
+        try:
+            send_frame(sock, STREAM, pack_stream(transfer_id, index, count, ranges))
+            # Codecs keep state, so every stream gets its own.
+            codec = Codec(self.codec) if self.codec else None
+            # Folders of small files take the buffered path, which packs many
+            # files into every chunk instead of one sendfile call per file.
+            zero_copy = self.zero_copy and self.batch.size >= len(self.batch.members) * self.settings.chunk_size
+            if zero_copy and not codec and not self.settings.hash_name:
+                with BatchFile(self.batch, 'rb') as file:
+                    for offset, count in ranges:
+                        self.send_zero_copy(sock, file, offset, count, index)
+                return
+            # Hashing and compression read the bytes anyway, from a mapping
+            # they come without a copy into a buffer of ours.
+            mapped = self.settings.maps(self.batch.size)
+            with (MappedFile if mapped else BatchFile)(self.batch, 'rb') as file:
+                with DiskQueue(file, 0 if mapped else self.settings.pipeline, self.settings.chunk_size, self.metrics) as disk:
+                    for offset, count in ranges:
+                        if codec or self.settings.hash_name:
+                            self.send_blocks(sock, disk, offset, count, index, codec)
+                        else:
+                            self.send_buffered(sock, disk, offset, count, index)
+        except (OSError, EOFError) as error:
+            print("Stream {} failed: {}".format(index, error))
+            self.stop()
+
+    def load_batch(self):
+        # Done before connecting, a path that cannot be read must not use up
+        # a receiver that accepts a single transfer.
+        paths = [self.file_path] if isinstance(self.file_path, str) else list(self.file_path)
+        self.batch = Batch.from_paths(paths)
+        self.header = self.batch.header()
+
+    def run(self):
+        try:
+            self.load_batch()
+        except OSError as error:
+            print("Cannot read files:", error)
+            self.on_failed()
+            return
+
+        with self.metrics.span("connect"):
+            self.client = self.connect()
+        if self.client is None:
+            return
+
+        header = self.header
+        control = threading.Thread(target=self.read_control, daemon=True)
+        workers = []
+
+        try:
+            with self.metrics.span("handshake"):
+                streams = self.handshake(header)
+            with self.metrics.span("streams"):
+                connections = [self.client] + [self.connect() for _ in streams[1:]]
+            if None in connections:
+                raise ConnectionError("Sender stopped")
+            self.sent = [0] * len(streams)
+            # The rate meter starts here, so short transfers still get a rate.
+            self.meter.update(self.acknowledged)
+            self.on_connected()
+            control.start()
+
+            for index, (sock, ranges) in enumerate(zip(connections, streams)):
+                worker = threading.Thread(target=self.send_stream, args=(sock, header.transfer_id, index, len(streams), ranges))
+                worker.start()
+                workers.append(worker)
+        except (OSError, ConnectionError, ProtocolError):
+            self.stop()
+
+        with self.metrics.span("transfer"):
+            for worker in workers:
+                worker.join()
+
+        if self.settings.hash_name and workers and not self.stop_request and not self.cancelled:
+            try:
+                send_frame(self.client, TRAILER, root_digest(self.settings.hash_name, self.digests))
+            except OSError:
+                pass
+
+        if self.stop_request:
+            shutdown(self.client)
+        if control.ident is not None:
+            control.join()
+        self.metrics.sockets(self.sockets)
+        for sock in self.sockets:
+            sock.close()
+
+        if self.finished:
+            self.on_finished()
+            print("File Transfer Successfully.")
+        else:
+            self.on_failed()
+            print("File Transfer Failed")
+
+class FileReceiver:
+    def __init__(self, host: str, port: int, save_path: str, settings=None):
+        self.host = host
+        self.port = port
+        self.save_path = save_path
+        self.settings = settings or TransferSettings()
+        self.file_path = None
+        self.stop_request = False
+        self.connected = False
+        self.buffer_size = self.settings.chunk_size
+        self.header = None
+        self.partial_path = None
+        self.journal_path = None
+        self.manifest_id = None
+        self.batch = None
+        self.incoming = None
+        self.resumed = []
+        self.committed = []
+        self.synced = 0
+        self.digests = []
+        self.stream_received = []
+        self.stream_count = 0
+        self.client = None
+        self.server = None
+        self.sockets = []
+        self.meter = RateMeter()
+        self.metrics = Metrics(self.settings.trace)
+
+        self.on_connected = _noop
+        self.on_progress = _noop
+        self.on_failed = _noop
+        self.on_finished = _noop
+        # Called once the header is in, may raise ProtocolError to refuse it.
+        self.on_header = _noop
+
+    @property
+    def received(self):
+        return sum(self.stream_received)
+
+    @property
+    def completed(self):
+        return sum(count for _, count in self.resumed) + self.received
+
+    @property
+    def complete(self):
+        return not missing_ranges(self.resumed + self.committed, self.header.size)
+
+    @property
+    def flush_size(self):
+        return max(WRITE_ALIGNMENT, self.buffer_size - self.buffer_size % WRITE_ALIGNMENT)
+
+    def stop(self):
+        self.stop_request = True
+        for sock in self.sockets:
+            shutdown(sock, socket.SHUT_RD)
+
+    def accept(self, timeout=None):
+        self.server.settimeout(0.5)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.stop_request:
+            try:
+                client, client_addr = self.server.accept()
+            except socket.timeout:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise ConnectionError("Timed out waiting for a stream connection")
+                continue
+            client.settimeout(None)
+            self.sockets.append(client)
+            print("Client connected: ", client_addr)
+            return client
+        raise ConnectionError("Receiver stopped")
+
+    def run(self):
+        os.makedirs(self.save_path, exist_ok=True)
+
+        try:
+            self.server = listen(self.host, self.port, self.settings)
+        except OSError as error:
+            print("Failed to listen:", error)
+            self.on_failed()
+            return
+
+        print("Server listening on {}:{}".format(self.host, self.port))
+
+        try:
+            client = self.accept()
+        except ConnectionError:
+            self.server.close()
+            return
+        except OSError as error:
+            self.server.close()
+            print("Failed to accept:", error)
+            self.on_failed()
+            return
+
+        try:
+            self.serve(client)
+        finally:
+            self.server.close()
+
+    def serve(self, client):
+        self.client = client
+        if client not in self.sockets:
+            self.sockets.append(client)
+        self.connected = True
+
+        try:
+            self.receive()
+        except (OSError, ConnectionError, ProtocolError, struct.error) as error:
+            print("Failed to receive file:", error)
+            self.on_failed()
+        finally:
+            self.metrics.sockets(self.sockets)
+            for sock in self.sockets:
+                sock.close()
+            while self.incoming is not None and not self.incoming.empty():
+                self.incoming.get()[0].close()
+
+    def next_stream(self):
+        # Standalone receivers accept secondary connections themselves, under
+        # a ReceiverServer they are routed in through the incoming queue.
+        if self.incoming is None:
+            sock = self.accept(STREAM_TIMEOUT)
+            return (sock,) + recv_frame(sock)
+
+        deadline = time.monotonic() + STREAM_TIMEOUT
+        while not self.stop_request:
+            try:
+                sock, payload = self.incoming.get(timeout=0.5)
+            except queue.Empty:
+                if time.monotonic() > deadline:
+                    raise ConnectionError("Timed out waiting for a stream connection")
+                continue
+            self.sockets.append(sock)
+            return sock, STREAM, payload
+        raise ConnectionError("Receiver stopped")
+
+    def open_streams(self, header):
+        # Secondary connections may arrive in any order, each names its slot.
+        streams = {}
+        sock = self.client
+        kind, payload = recv_frame(sock)
+        while True:
+            count = self.add_stream(streams, header, sock, kind, payload)
+            if len(streams) == count:
+                return [streams[index] for index in range(count)]
+            sock, kind, payload = self.next_stream()
+
+    def add_stream(self, streams, header, sock, kind, payload):
+        # Checks a STREAM frame against the transfer and the streams so far
+        # and returns the stream count the first one announced.
+        if kind != STREAM:
+            raise ProtocolError("Expected stream frame")
+        transfer_id, index, count, ranges = unpack_stream(payload)
+        if streams:
+            expected = self.stream_count
+        else:
+            expected = self.stream_count = count
+        if transfer_id != header.transfer_id or count != expected or index >= count or index in streams:
+            raise ProtocolError("Stream does not belong to this transfer")
+        if not streams and index != 0:
+            raise ProtocolError("First stream must be the control connection")
+        if any(offset + size > header.size for offset, size in ranges):
+            raise ProtocolError("Stream range outside of the file")
+        streams[index] = (sock, ranges)
+        return count
+
+    def stream_written(self, index):
+        # Runs on the disk queue, progress counts bytes that are on disk.
+        def written(count):
+            self.stream_received[index] += count
+        return written
+
+    def receive_stream(self, sock, disk, offset, size, index, hasher=None):
+        # Socket data lands in pooled buffers that go to the disk queue in
+        # buffer sized writes while the next one fills. On slow links the
+        # buffer is flushed early every ACK_INTERVAL, keeping writes aligned
+        # and carrying the tail over into the next buffer.
+        buffer_size = self.flush_size
+        buffer = disk.take()
+        view = memoryview(buffer)
+        written = self.stream_written(index)
+        filled = 0
+        received = 0
+        last_flush = time.monotonic()
+        reads = writes = wire = 0
+        network = hashing = 0.0
+
+        try:
+            while received < size and not self.stop_request:
+                limit = min(buffer_size, size - received)
+                clock = time.perf_counter()
+                count = sock.recv_into(view[filled:limit])
+                network += time.perf_counter() - clock
+                reads += 1
+                if not count:
+                    break
+                filled += count
+                wire += count
+
+                flush = flush_due(filled, limit, last_flush)
+                if flush is None:
+                    continue
+
+                last_flush = time.monotonic()
+                if flush:
+                    if hasher is not None:
+                        clock = time.perf_counter()
+                        hasher.update(view[:flush])
+                        hashing += time.perf_counter() - clock
+                    following = disk.take()
+                    following[:filled - flush] = view[flush:filled]
+                    disk.write_at(buffer, view[:flush], offset + received, written)
+                    buffer, view = following, memoryview(following)
+                    writes += 1
+                    filled -= flush
+                    received += flush
+        finally:
+            disk.give(buffer)
+            self.metrics.add(socket_recv_calls=reads, disk_write_calls=writes, network_wait_seconds=network,
+                             hash_seconds=hashing, bytes_received=wire, payload_bytes=received)
+
+        return received == size
+
+    def receive_mapped(self, sock, file, offset, size, index, hasher=None):
+        # The socket reads straight into the mapped file, the kernel writes
+        # the dirty pages back on its own schedule.
+        received = 0
+        reads = 0
+        network = hashing = 0.0
+        try:
+            for part in file.parts(offset, size):
+                filled = 0
+                while filled < len(part) and not self.stop_request:
+                    clock = time.perf_counter()
+                    count = sock.recv_into(part[filled:])
+                    network += time.perf_counter() - clock
+                    reads += 1
+                    if not count:
+                        return False
+                    if hasher is not None:
+                        clock = time.perf_counter()
+                        hasher.update(part[filled:filled + count])
+                        hashing += time.perf_counter() - clock
+                    filled += count
+                    received += count
+                    self.stream_received[index] += count
+                if self.stop_request:
+                    return False
+        finally:
+            self.metrics.add(socket_recv_calls=reads, network_wait_seconds=network, hash_seconds=hashing,
+                             bytes_received=received, payload_bytes=received)
+        return received == size
+
+    def receive_compressed(self, sock, disk, offset, size, index, codec, hasher=None):
+        # Decompressed chunks are fresh objects, they go to the disk queue
+        # as they are and the queue depth alone bounds them.
+        written = self.stream_written(index)
+        received = 0
+        frames = wire = 0
+        network = hashing = unpacking = 0.0
+        try:
+            while received < size and not self.stop_request:
+                clock = time.perf_counter()
+                kind, payload = recv_frame(sock)
+                network += time.perf_counter() - clock
+                frames += 1
+                wire += FRAME.size + len(payload)
+                if kind != DATA or not payload:
+                    raise ProtocolError("Expected data frame")
+                clock = time.perf_counter()
+                data = memoryview(codec.unpack(payload[0], memoryview(payload)[1:], size - received))
+                unpacking += time.perf_counter() - clock
+                if len(data) > size - received:
+                    raise ProtocolError("Data frame runs past its block")
+                if hasher is not None:
+                    clock = time.perf_counter()
+                    hasher.update(data)
+                    hashing += time.perf_counter() - clock
+                disk.write_at(None, data, offset + received, written)
+                received += len(data)
+        finally:
+            self.metrics.add(data_frames=frames, disk_write_calls=frames, network_wait_seconds=network,
+                             hash_seconds=hashing, decompress_seconds=unpacking,
+                             bytes_received=wire, payload_bytes=received)
+        return received == size
+
+    def receive_ranges(self, sock, ranges, index):
+        # Ranges are taken in blocks. A block only makes it into the journal
+        # once it is complete and, with hashing on, matches the sender digest.
+        hash_name = self.header.hash_name
+        codec = Codec(self.header.codec) if self.header.codec else None
+        mapped = self.settings.maps(self.header.size)
+        try:
+            with (MappedFile if mapped else BatchFile)(self.batch, 'r+b') as file, \
+                    DiskQueue(file, 0 if mapped else self.settings.pipeline, self.flush_size, self.metrics) as disk:
+                for offset, count in ranges:
+                    for offset, count in segments(offset, count):
+                        hasher = new_hash(hash_name) if hash_name else None
+                        if codec is not None:
+                            done = self.receive_compressed(sock, disk, offset, count, index, codec, hasher)
+                        elif mapped:
+                            done = self.receive_mapped(sock, file, offset, count, index, hasher)
+                        else:
+                            done = self.receive_stream(sock, disk, offset, count, index, hasher)
+                        if not done:
+                            return
+                        if hasher is not None:
+                            self.check_block(hasher, offset, *recv_frame(sock))
+                        disk.submit(self.committed.append, (offset, count))
+        except (OSError, ConnectionError, ProtocolError) as error:
+            print("Stream {} failed: {}".format(index, error))
+
+    def check_block(self, hasher, offset, kind, digest):
+        if kind != DIGEST or digest != hasher.digest():
+            raise ProtocolError("Checksum mismatch in block at {}".format(offset))
+        self.digests.append((offset, digest))
+
+    def acknowledge(self):
+        send_frame(self.client, ACK, OFFSET.pack(self.completed))
+        self.meter.update(self.completed)
+        self.on_progress(self.completed)
+
+    def load_journal(self, header):
+        # A journal is only trusted for the very same source file, otherwise
+        # the partial copy is thrown away and the file is fetched again.
+        try:
+            with open(self.journal_path) as file:
+                journal = json.load(file)
+            if (journal["name"], journal["size"], journal["mtime"]) != (header.name, header.size, header.mtime):
+                return []
+            if journal.get("manifest") != self.manifest_id:
+                return []
+            for member, path in zip(self.batch.members, self.batch.paths):
+                if os.path.getsize(path) != member.size:
+                    return []
+            # The root digest covers resumed blocks too, so with hashing on
+            # only a journal of the same hash, which has their digests, does.
+            if journal.get("hash") != header.hash_name:
+                return [] if header.hash_name else merge_ranges(tuple(item) for item in journal["ranges"])
+            ranges = merge_ranges(tuple(item) for item in journal["ranges"])
+            # Digests of blocks that never made it into the ranges are dropped.
+            self.digests = [(offset, bytes.fromhex(digest)) for offset, digest in journal.get("digests", [])
+                            if any(start <= offset < start + count for start, count in ranges)]
+            return ranges
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
+
+    def save_journal(self):
+        # Streams keep committing while this runs, the journal only lists
+        # what was committed, and with periodic syncs synced, before it.
+        committed = self.committed[:]
+        # A block's digest is in before the block is committed.
+        digests = self.digests[:]
+        periodic = self.settings.durability == "periodic"
+        if periodic:
+            self.sync(committed[self.synced:])
+            self.synced = len(committed)
+        journal = {
+            "name": self.header.name,
+            "size": self.header.size,
+            "mtime": self.header.mtime,
+            "manifest": self.manifest_id,
+            "ranges": merge_ranges(self.resumed + committed),
+            "hash": self.header.hash_name,
+            "digests": [[offset, digest.hex()] for offset, digest in digests],
+        }
+        with open(self.journal_path + ".tmp", "w") as file:
+            json.dump(journal, file)
+            if periodic:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(self.journal_path + ".tmp", self.journal_path)
+
+    def sync(self, ranges):
+        # Flushes the members the ranges touch, each one once.
+        members = sorted({index for offset, count in ranges for index, _, _ in self.batch.pieces(offset, count)})
+        clock = time.perf_counter()
+        for index in members:
+            sync_path(self.batch.paths[index])
+        self.metrics.add(sync_calls=len(members), sync_seconds=time.perf_counter() - clock)
+
+    def handshake(self):
+        while True:
+            header, reply = self.handshake_frame(*recv_frame(self.client))
+            if header is not None:
+                return header
+            if reply is not None:
+                send_frame(self.client, *reply)
+
+    def handshake_frame(self, kind, payload):
+        # Takes one frame before the header. Returns the header once it is
+        # in, or else the reply the frame needs, if any.
+        if kind == HEADER:
+            header = FileHeader.unpack(payload)
+            if header.hash_name:
+                new_hash(header.hash_name)
+            if header.codec:
+                Codec(header.codec)
+            return header, None
+        elif kind == PING:
+            return None, (PONG, payload)
+        elif kind == PROBE:
+            return None, (ACK, OFFSET.pack(len(payload)))
+        elif kind == TUNE:
+            # Buffers of an accepted socket are left to the OS here, a
+            # late SO_RCVBUF would only disable receive autotuning.
+            if self.settings.auto:
+                (self.buffer_size,) = CHUNK.unpack(payload)
+            return None, None
+        raise ProtocolError("Unexpected frame {} during handshake".format(kind))
+
+    def receive_manifest(self, header):
+        if header.files is None:
+            return Batch([header], [self.partial_path])
+
+        kind, payload = recv_frame(self.client)
+        if kind != MANIFEST:
+            raise ProtocolError("Expected manifest frame")
+        return self.manifest_batch(header, payload)
+
+    def manifest_batch(self, header, payload):
+        # Members are written under the partial folder at their relative
+        # paths, the folder is renamed as a whole once everything is in.
+        members = unpack_manifest(payload)
+        if len(members) != header.files or sum(member.size for member in members) != header.size:
+            raise ProtocolError("Manifest does not match the header")
+        if len(set(member.name for member in members)) != len(members):
+            raise ProtocolError("Duplicate names in manifest")
+        self.manifest_id = hashlib.sha256(payload).hexdigest()
+        return Batch(members, [member_path(self.partial_path, member.name) for member in members], header.name)
+
+    def prepare(self, header):
+        # Partial data is kept next to a journal of the ranges already on
+        # disk, so an interrupted transfer only fetches what is missing.
+        self.header = header
+        self.partial_path = self.save_path + "/" + os.path.basename(header.name) + ".part"
+        self.journal_path = self.partial_path + ".json"
+        self.on_header(self)
+
+    def allocate(self):
+        header = self.header
+        self.resumed = self.load_journal(header)
+        if not self.resumed:
+            if header.files is not None:
+                shutil.rmtree(self.partial_path, ignore_errors=True)
+                os.makedirs(self.partial_path)
+            for member, path in zip(self.batch.members, self.batch.paths):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as file:
+                    preallocate(file, member.size)
+        return missing_ranges(self.resumed, header.size)
+
+    def receive(self):
+        with self.metrics.span("handshake"):
+            header = self.handshake()
+            self.prepare(header)
+            self.batch = self.receive_manifest(header)
+        with self.metrics.span("allocate"):
+            missing = self.allocate()
+        send_frame(self.client, RANGES, pack_ranges(missing))
+        if header.hash_name:
+            send_frame(self.client, DIGEST, pack_digests(self.digests))
+
+        with self.metrics.span("streams"):
+            streams = self.open_streams(header)
+        self.stream_received = [0] * len(streams)
+        self.meter.update(self.completed)
+        self.on_connected(header.name, header.size)
+
+        workers = []
+        try:
+            with self.metrics.span("transfer"):
+                for index, (sock, ranges) in enumerate(streams):
+                    worker = threading.Thread(target=self.receive_ranges, args=(sock, ranges, index))
+                    worker.start()
+                    workers.append(worker)
+
+                last_save = time.monotonic()
+                for worker in workers:
+                    while worker.is_alive():
+                        worker.join(ACK_INTERVAL)
+                        self.acknowledge()
+                        if time.monotonic() - last_save >= JOURNAL_INTERVAL:
+                            self.save_journal()
+                            last_save = time.monotonic()
+        finally:
+            self.stop_workers(workers)
+
+        with self.metrics.span("verify"):
+            verified = self.complete and self.verify()
+        if self.complete and not verified:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self.on_failed()
+            print("File failed verification, it will be fetched again")
+        elif self.complete:
+            with self.metrics.span("finish"):
+                self.finish()
+            self.acknowledge()
+            send_frame(self.client, DONE)
+            self.on_finished()
+            print("File received successfully.")
+        else:
+            if self.stop_request:
+                send_frame(self.client, CANCEL)
+            self.on_failed()
+            kept = sum(count for _, count in merge_ranges(self.resumed + self.committed))
+            print("Failed to receive file, kept {} of {} bytes to resume later".format(kept, header.size))
+
+    def verify(self):
+        if not self.header.hash_name:
+            return True
+        return self.check_trailer(*recv_frame(self.client))
+
+    def check_trailer(self, kind, payload):
+        if kind != TRAILER:
+            raise ProtocolError("Expected trailer frame")
+        return payload == root_digest(self.header.hash_name, self.digests)
+
+    def stop_workers(self, workers):
+        if any(worker.is_alive() for worker in workers):
+            for sock in self.sockets:
+                shutdown(sock, socket.SHUT_RD)
+            for worker in workers:
+                worker.join()
+        if not self.complete:
+            self.save_journal()
+
+    def finish(self):
+        (tm_year, tm_mon, tm_mday, tm_hour, tm_min, tm_sec, _, _, _) = time.localtime()
+        name_mark = "PF ["+ str(tm_mday) +"-"+ str(tm_mon) +"-"+ str(tm_year) +"]" + "["+ str(tm_hour) +"-"+ str(tm_min) +"-"+ str(tm_sec) +"] "
+
+        self.file_path = self.save_path + "/" + name_mark + os.path.basename(self.header.name)
+        if self.settings.durability != "none":
+            self.sync([(0, self.header.size)])
+        os.replace(self.partial_path, self.file_path)
+        if self.settings.durability != "none":
+            # The rename only survives a crash once the folder is synced,
+            # which not every platform can do.
+            with contextlib.suppress(OSError):
+                sync_path(self.save_path, data_only=False)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        if self.header.files is None:
+            self.header.apply(self.file_path)
+            return
+        for member in self.batch.members:
+            member.apply(member_path(self.file_path, member.name))
+
+class ReceiverServer:
+    # Keeps listening and takes transfers from many senders at once. Every
+    # transfer runs as a FileReceiver on a pool thread, at most limit at a
+    # time; later senders wait their turn. Secondary stream connections are
+    # recognised by their STREAM frame and handed to the receiver that owns
+    # the transfer id.
+    def __init__(self, host: str, port: int, save_path: str, settings=None, limit=MAX_TRANSFERS):
+        self.host = host
+        self.port = port
+        self.save_path = save_path
+        self.settings = settings or TransferSettings()
+        self.limit = max(1, limit)
+        self.stop_request = False
+        self.receivers = {}
+        self.sessions = set()
+        self.count = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.pool = None
+
+        self.on_started = _noop
+        self.on_progress = _noop
+        self.on_failed = _noop
+        self.on_finished = _noop
+        # Called with the number and the receiver once a session is over.
+        self.on_closed = _noop
+        # Called with the OSError that keeps the server from listening.
+        self.on_error = _noop
+
+    def stop(self):
+        self.stop_request = True
+        with self.lock:
+            sessions = list(self.sessions)
+        for receiver in sessions:
+            receiver.stop()
+
+    def run(self):
+        os.makedirs(self.save_path, exist_ok=True)
+
+        try:
+            self.server = listen(self.host, self.port, self.settings)
+        except OSError as error:
+            print("Failed to listen:", error)
+            self.on_error(error)
+            return
+        self.server.settimeout(0.5)
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.limit)
+
+        print("Server listening on {}:{}, up to {} transfers at once".format(self.host, self.port, self.limit))
+
+        try:
+            while not self.stop_request:
+                try:
+                    client, client_addr = self.server.accept()
+                except socket.timeout:
+                    continue
+                client.settimeout(None)
+                print("Client connected: ", client_addr)
+                threading.Thread(target=self.dispatch, args=(client,), daemon=True).start()
+        except OSError as error:
+            print("Server stopped:", error)
+            self.on_error(error)
+        finally:
+            self.server.close()
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def dispatch(self, client):
+        # Only the frame kind is peeked at, a new transfer starts on the pool
+        # with its connection untouched.
+        try:
+            client.settimeout(STREAM_TIMEOUT)
+            kind = client.recv(1, socket.MSG_PEEK)
+            if kind and kind[0] == STREAM:
+                _, payload = recv_frame(client)
+                transfer_id = unpack_stream(payload)[0]
+                with self.lock:
+                    receiver = self.receivers.get(transfer_id)
+                if receiver is None:
+                    raise ProtocolError("Stream for an unknown transfer")
+                client.settimeout(None)
+                receiver.incoming.put((client, payload))
+                return
+            if not kind:
+                raise ConnectionError("Connection closed by peer")
+            client.settimeout(None)
+            self.pool.submit(self.session, client)
+        except (OSError, ConnectionError, ProtocolError, RuntimeError, struct.error) as error:
+            print("Dropped connection:", error)
+            client.close()
+
+    def register(self, receiver):
+        with self.lock:
+            for other in self.receivers.values():
+                if other.partial_path == receiver.partial_path:
+                    raise ProtocolError("Already receiving {}".format(receiver.header.name))
+            self.receivers[receiver.header.transfer_id] = receiver
+
+    def session(self, client):
+        if self.stop_request:
+            client.close()
+            return
+
+        with self.lock:
+            self.count += 1
+            number = self.count
+        receiver = FileReceiver(self.host, self.port, self.save_path, self.settings)
+        receiver.incoming = queue.Queue()
+        receiver.on_header = self.register
+        receiver.on_connected = lambda name, size: self.on_started(number, name, size)
+        receiver.on_progress = lambda completed: self.on_progress(number, completed)
+        receiver.on_finished = lambda: self.on_finished(number)
+        receiver.on_failed = lambda: self.on_failed(number)
+
+        with self.lock:
+            self.sessions.add(receiver)
+        if self.stop_request:
+            receiver.stop()
+        try:
+            receiver.serve(client)
+        finally:
+            with self.lock:
+                self.sessions.discard(receiver)
+                if receiver.header is not None and self.receivers.get(receiver.header.transfer_id) is receiver:
+                    del self.receivers[receiver.header.transfer_id]
+            self.on_closed(number, receiver)
+
+def settings_from_args(args):
+    return TransferSettings(args.profile, args.chunk_kb * 1024, args.buffer_kb * 1024, not args.nagle,
+                            args.streams, args.hash, args.compress, args.trace, args.pipeline,
+                            {"auto": None, "on": True, "off": False}[args.mmap], args.durability)
+
+def export_metrics(path, role, engine):
+    labels = {"role": role}
+    if engine.header is not None:
+        labels.update(name=engine.header.name, transfer=(engine.header.transfer_id or b"").hex())
+    engine.metrics.export(path, **labels)
+
+def server_metrics(path):
+    # A .prom file is rewritten after every transfer, so it holds the totals
+    # of all transfers the server took. JSON lines get one per transfer.
+    totals = Metrics()
+    lock = threading.Lock()
+    def closed(number, receiver):
+        if not path.endswith(".prom"):
+            export_metrics(path, "receiver", receiver)
+            return
+        with lock:
+            totals.merge(receiver.metrics)
+            totals.add(transfers=1)
+            totals.export(path, role="receiver")
+    return closed
+
+def run_until_done(engine):
+    # The engine runs on a worker thread so Ctrl+C reaches the main thread
+    # and can stop it cleanly, keeping partial files for a later resume.
+    worker = threading.Thread(target=engine.run)
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(0.2)
+    except KeyboardInterrupt:
+        print("\nStopping...")
+        engine.stop()
+        worker.join()
+
+def report_progress(meter, total):
+    # The final line is printed once, with the average rate of the transfer.
+    last = [0.0]
+    finished = [False]
+    def report(done):
+        now = time.monotonic()
+        size = total() or 1
+        final = done >= size
+        if finished[0] or not final and now - last[0] < 0.2:
+            return
+        last[0] = now
+        finished[0] = final
+        eta = meter.eta(size)
+        print("\r{:.1f} / {:.1f} MB  {:.0f} %  {:.1f} MB/s  ETA {}   ".format(
+            done / 1e6, size / 1e6, done * 100 / size, (meter.average() if final else meter.current()) / 1e6,
+            "--:--" if eta is None else "{}:{:02d}".format(*divmod(round(eta), 60))), end="", flush=True)
+    return report
+
+def main(argv=None):
+    import argparse
+
+    def at_least(minimum):
+        def parse(text):
+            value = int(text)
+            if value < minimum:
+                raise argparse.ArgumentTypeError("must be at least {}, got {}".format(minimum, value))
+            return value
+        return parse
+
+    parser = argparse.ArgumentParser(prog="phantomfile", description="Send and receive files over TCP without the GUI.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send = commands.add_parser("send", help="send files or folders to a receiver")
+    send.add_argument("host", help="receiver address, or a Unix socket path")
+    send.add_argument("paths", nargs="+")
+
+    recv = commands.add_parser("recv", help="receive one transfer and exit")
+    serve = commands.add_parser("serve", help="keep receiving transfers from many senders")
+    serve.add_argument("--clients", type=at_least(1), default=MAX_TRANSFERS, help="transfers received at once")
+    for command in (recv, serve):
+        command.add_argument("--host", default="0.0.0.0", help="address to listen on, or a Unix socket path")
+        command.add_argument("--save", default=".", help="folder to save into")
+
+    for command in (send, recv, serve):
+        command.add_argument("--port", type=int, default=9999)
+        command.add_argument("--profile", default="auto", choices=["auto", "custom"] + list(PROFILES))
+        command.add_argument("--chunk-kb", type=at_least(1), default=CHUNK_SIZE // 1024)
+        command.add_argument("--buffer-kb", type=at_least(0), default=0)
+        command.add_argument("--streams", type=at_least(0), default=0)
+        command.add_argument("--hash", default="none", choices=HASHES,
+                             help="verify every block and the whole file, at the cost of the zero-copy send")
+        command.add_argument("--compress", default="auto", choices=COMPRESSIONS)
+        command.add_argument("--nagle", action="store_true", help="leave TCP_NODELAY off")
+        command.add_argument("--metrics", help="append per-transfer metrics as JSON lines, or write a .prom file")
+        command.add_argument("--trace", action="store_true", help="record per-phase timing spans in the metrics")
+        command.add_argument("--pipeline", type=at_least(0), help="disk reads or writes queued ahead per stream, 0 for none")
+        command.add_argument("--mmap", default="auto", choices=["auto", "on", "off"],
+                             help="go through memory maps, auto does for files of {} GiB and up".format(MAPPED_MIN_FILE_SIZE >> 30))
+        command.add_argument("--durability", default="none", choices=DURABILITY,
+                             help="receiver syncs to disk: never, once complete, or before every journal save")
+
+    args = parser.parse_args(argv)
+    settings = settings_from_args(args)
+
+    if args.command == "serve":
+        server = ReceiverServer(args.host, args.port, args.save, settings, args.clients)
+        server.on_started = lambda number, name, size: print("[{}] Receiving {} ({:.1f} MB)".format(number, name, size / 1e6))
+        server.on_finished = lambda number: print("[{}] Done".format(number))
+        server.on_failed = lambda number: print("[{}] Failed".format(number))
+        if args.metrics:
+            server.on_closed = server_metrics(args.metrics)
+        run_until_done(server)
+        return 0
+
+    if args.command == "send":
+        missing = [path for path in args.paths if not os.path.exists(path)]
+        if missing:
+            print("phantomfile: no such file or folder:", ", ".join(missing), file=sys.stderr)
+            return 1
+        engine = FileSender(args.host, args.port, args.paths, settings)
+        engine.on_progress = report_progress(engine.meter, lambda: engine.batch.size)
+    else:
+        engine = FileReceiver(args.host, args.port, args.save, settings)
+        engine.on_progress = report_progress(engine.meter, lambda: engine.header.size)
+
+    # The engine reports the outcome right after these callbacks, so they
+    # only end the progress line.
+    outcome = []
+    engine.on_finished = lambda: outcome.append(print() or True)
+    engine.on_failed = lambda: outcome.append(print() or False)
+    run_until_done(engine)
+    if args.metrics:
+        export_metrics(args.metrics, "sender" if args.command == "send" else "receiver", engine)
+    return 0 if True in outcome else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+import os
+import glob
+import socket
+import asyncio
+import threading
+import time
+
+import pytest
+
+from phantomfile import FileSender, FileReceiver, TransferSettings, Batch, BatchFile, Metrics, HASH_BLOCK
+from phantomasync import AsyncFileSender, AsyncFileReceiver, AsyncReceiverServer, AsyncDiskQueue
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def source_file(folder, name, size):
+    path = folder / name
+    path.write_bytes(os.urandom(size))
+    return path
+
+def received(folder, name):
+    paths = glob.glob(str(folder / ("PF *" + name)))
+    assert len(paths) == 1
+    with open(paths[0], "rb") as file:
+        return file.read()
+
+async def listening(engine):
+    deadline = time.monotonic() + 5
+    while engine.server is None and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+def test_async_sender_to_sync_receiver(tmp_path):
+    source = source_file(tmp_path, "source.bin", 2 * HASH_BLOCK + 777)
+    port = free_port()
+    receiver = FileReceiver("127.0.0.1", port, str(tmp_path / "out"), TransferSettings("custom"))
+    thread = threading.Thread(target=receiver.run)
+    thread.start()
+    while receiver.server is None:
+        time.sleep(0.01)
+    settings = TransferSettings("custom", streams=2, hash_name="crc32", compression="none")
+    sender = AsyncFileSender("127.0.0.1", port, str(source), settings)
+    asyncio.run(sender.run())
+    thread.join(10)
+    assert sender.finished
+    assert received(tmp_path / "out", "source.bin") == source.read_bytes()
+
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+def test_sync_sender_to_async_receiver(tmp_path, compression):
+    source = tmp_path / "source.txt"
+    source.write_bytes(b"".join(b"line %d of the log\n" % number for number in range(500000)))
+    port = free_port()
+
+    async def main():
+        receiver = AsyncFileReceiver("127.0.0.1", port, str(tmp_path / "out"), TransferSettings("custom"))
+        task = asyncio.ensure_future(receiver.run())
+        await listening(receiver)
+        settings = TransferSettings("custom", streams=3, hash_name="sha256", compression=compression)
+        sender = FileSender("127.0.0.1", port, str(source), settings)
+        await asyncio.get_running_loop().run_in_executor(None, sender.run)
+        await asyncio.wait_for(task, 10)
+        return sender
+
+    assert asyncio.run(main()).finished
+    assert received(tmp_path / "out", "source.txt") == source.read_bytes()
+
+def test_async_server_takes_concurrent_senders(tmp_path):
+    sources = [source_file(tmp_path, "file{}.bin".format(number), (number + 1) * 1024 * 1024) for number in range(4)]
+    port = free_port()
+    finished = []
+
+    async def main():
+        server = AsyncReceiverServer("127.0.0.1", port, str(tmp_path / "out"), TransferSettings("custom"), limit=2)
+        server.on_finished = finished.append
+        task = asyncio.ensure_future(server.run())
+        await listening(server)
+        senders = [AsyncFileSender("127.0.0.1", port, str(source), TransferSettings("custom", streams=2, hash_name="crc32"))
+                   for source in sources]
+        await asyncio.wait_for(asyncio.gather(*(sender.run() for sender in senders)), 30)
+        server.stop()
+        await task
+        return senders
+
+    assert all(sender.finished for sender in asyncio.run(main()))
+    assert sorted(finished) == [1, 2, 3, 4]
+    for source in sources:
+        assert received(tmp_path / "out", source.name) == source.read_bytes()
+
+class SlowSender(AsyncFileSender):
+    async def send_buffered(self, sock, disk, offset, count, index, hasher=None, codec=None):
+        await asyncio.sleep(0.05)
+        await super().send_buffered(sock, disk, offset, count, index, hasher, codec)
+
+def test_cancelled_receiver_keeps_partial_file(tmp_path):
+    source = source_file(tmp_path, "source.bin", 20 * HASH_BLOCK)
+    port = free_port()
+    outcome = []
+
+    async def main():
+        receiver = AsyncFileReceiver("127.0.0.1", port, str(tmp_path / "out"), TransferSettings("custom"))
+        receiver.on_failed = lambda: outcome.append("failed")
+        receiver.on_finished = lambda: outcome.append("finished")
+        task = asyncio.ensure_future(receiver.run())
+        await listening(receiver)
+        sender = SlowSender("127.0.0.1", port, str(source), TransferSettings("custom", streams=1, hash_name="crc32"))
+        sending = asyncio.ensure_future(sender.run())
+        while not receiver.committed:
+            await asyncio.sleep(0.01)
+        receiver.stop()
+        await asyncio.wait_for(task, 5)
+        await asyncio.wait_for(sending, 5)
+        return sender, receiver
+
+    sender, receiver = asyncio.run(main())
+    assert outcome == ["failed"]
+    assert not sender.finished
+    assert os.path.exists(receiver.partial_path)
+    assert os.path.exists(receiver.journal_path)
+
+@pytest.mark.parametrize("depth", [0, 2])
+def test_async_disk_queue_keeps_jobs_in_order(tmp_path, depth):
+    source = source_file(tmp_path, "source.bin", 10 * 1024 + 5)
+    batch = Batch.from_paths([str(source)])
+    order = []
+
+    async def main():
+        with BatchFile(batch, 'rb') as file:
+            async with AsyncDiskQueue(file, depth, 1024, Metrics()) as disk:
+                assert (disk.executor is None) == (depth == 0)
+                chunks = [bytes(data) async for _, data in disk.read_ahead(0, batch.size, 1024)]
+                for number in range(20):
+                    await disk.submit(order.append, number)
+        return b"".join(chunks)
+
+    assert asyncio.run(main()) == source.read_bytes()
+    assert order == list(range(20))
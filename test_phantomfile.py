@@ -0,0 +1,290 @@
+import os
+import glob
+import math
+import mmap
+import socket
+import threading
+import time
+
+import pytest
+
+from phantomfile import (FileSender, FileReceiver, FileHeader, TransferSettings, Codec, RateMeter, Metrics, Batch,
+                         BatchFile, MappedFile, DiskQueue, ProtocolError, merge_ranges, missing_ranges, split_ranges,
+                         member_path, sync_path, HASH_BLOCK, WRITE_ALIGNMENT, RAW)
+
+def test_header_round_trip():
+    header = FileHeader("video.mp4", 123456789, mtime=1700000000123456789, mode=0o644)
+    header.transfer_id = b"12345678"
+    header.codec = "zlib"
+    header.files = 3
+    unpacked = FileHeader.unpack(header.pack())
+    assert (unpacked.name, unpacked.size, unpacked.mtime, unpacked.mode) == ("video.mp4", 123456789, 1700000000123456789, 0o644)
+    assert (unpacked.transfer_id, unpacked.codec, unpacked.files) == (b"12345678", "zlib", 3)
+    assert unpacked.hash_name is None and unpacked.digest is None
+
+def test_header_rejects_garbage():
+    with pytest.raises(ProtocolError):
+        FileHeader.unpack(b"XXXX" + bytes(20))
+    with pytest.raises(ProtocolError):
+        FileHeader.unpack(FileHeader("name", 1).pack()[:10])
+
+def test_merge_ranges():
+    assert merge_ranges([(10, 5), (0, 10), (30, 0), (20, 5), (22, 10)]) == [(0, 15), (20, 12)]
+    assert merge_ranges([]) == []
+
+def test_missing_ranges():
+    assert missing_ranges([], 100) == [(0, 100)]
+    assert missing_ranges([(10, 20), (50, 50)], 100) == [(0, 10), (30, 20)]
+    assert missing_ranges([(0, 100)], 100) == []
+
+def test_split_ranges():
+    ranges = [(0, 10 * WRITE_ALIGNMENT), (20 * WRITE_ALIGNMENT, 3 * WRITE_ALIGNMENT + 7)]
+    streams = split_ranges(ranges, 4)
+    assert len(streams) <= 4
+    pieces = [piece for stream in streams for piece in stream]
+    assert merge_ranges(pieces) == merge_ranges(ranges)
+    assert sum(count for _, count in pieces) == sum(count for _, count in ranges)
+    assert all(offset % WRITE_ALIGNMENT == 0 for offset, _ in (stream[0] for stream in streams))
+
+@pytest.mark.parametrize("name", ["../evil", "a/../../evil", "/etc/passwd", "a//b", "./a", "a/."])
+def test_member_path_refuses_escapes(name):
+    with pytest.raises(ProtocolError):
+        member_path("/save/folder.part", name)
+
+def test_member_path():
+    assert member_path("/save/folder.part", "sub/file.txt") == os.path.join("/save/folder.part", "sub", "file.txt")
+
+def test_codec_round_trip():
+    sender, receiver = Codec("zlib"), Codec("zlib")
+    text = b"phantom file " * 10000
+    noise = os.urandom(100000)
+    flag, data = sender.pack(text)
+    assert len(data) < len(text)
+    assert receiver.unpack(flag, data, len(text)) == text
+    flag, data = sender.pack(noise)
+    assert flag == RAW
+    assert receiver.unpack(flag, data, len(noise)) == noise
+
+@pytest.mark.parametrize("name", ["zlib", "lzma"])
+def test_codec_stops_at_the_limit(name):
+    codec = Codec(name)
+    flag, data = codec.pack(bytes(64 * 1024 * 1024))
+    assert len(Codec(name).unpack(flag, data, 1000)) == 1001
+    with pytest.raises(ProtocolError):
+        Codec(name).unpack(flag, data[:len(data) // 2], 64 * 1024 * 1024)
+
+def test_codec_rejects_unknown():
+    with pytest.raises(ProtocolError):
+        Codec("nonsense")
+
+@pytest.mark.parametrize("profile, bandwidth, expected", [
+    ("custom", None, None), ("lan", None, None), ("auto", None, None), ("wan", None, "zlib"),
+    ("auto", 1e12, None), ("auto", 1e6, "zlib")])
+def test_auto_compression(profile, bandwidth, expected, monkeypatch):
+    monkeypatch.setattr("phantomfile.CODECS", ["zlib"])
+    settings = TransferSettings(profile)
+    settings.bandwidth = bandwidth
+    assert settings.codec_for("notes.txt") == expected
+    assert settings.codec_for("movie.mp4") is None
+
+class InterruptedSender(FileSender):
+    # Sends the first block of its ranges, then stops as if the link dropped.
+    def send_blocks(self, sock, disk, offset, count, index, codec=None):
+        super().send_blocks(sock, disk, offset, HASH_BLOCK, index, codec)
+        self.stop()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def transfer(sender_class, source, save_path):
+    port = free_port()
+    receiver = FileReceiver("127.0.0.1", port, str(save_path), TransferSettings("custom"))
+    thread = threading.Thread(target=receiver.run)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while receiver.server is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    settings = TransferSettings("custom", streams=1, hash_name="sha256", compression="none")
+    sender = sender_class("127.0.0.1", port, str(source), settings)
+    sender.run()
+    thread.join(10)
+    assert not thread.is_alive()
+    return sender, receiver
+
+def test_interrupted_transfer_resumes(tmp_path):
+    data = os.urandom(3 * HASH_BLOCK + 12345)
+    source = tmp_path / "source.bin"
+    source.write_bytes(data)
+    save_path = tmp_path / "received"
+
+    sender, receiver = transfer(InterruptedSender, source, save_path)
+    assert not sender.finished
+    assert receiver.committed == [(0, HASH_BLOCK)]
+    assert os.path.exists(receiver.journal_path)
+
+    sender, receiver = transfer(FileSender, source, save_path)
+    assert sender.finished
+    assert receiver.resumed == [(0, HASH_BLOCK)]
+    assert len(receiver.digests) == 4
+    received = glob.glob(str(save_path / "PF *source.bin"))
+    assert len(received) == 1
+    with open(received[0], "rb") as file:
+        assert file.read() == data
+    assert not os.path.exists(receiver.journal_path)
+
+@pytest.mark.parametrize("values", [dict(chunk_size=0), dict(chunk_size=-1), dict(socket_buffer=-1), dict(streams=-1)])
+def test_settings_reject_invalid_values(values):
+    with pytest.raises(ValueError):
+        TransferSettings("custom", **values)
+
+def test_sender_fails_before_connecting_on_missing_path(tmp_path):
+    failed = []
+    sender = FileSender("127.0.0.1", free_port(), str(tmp_path / "missing.bin"))
+    sender.on_failed = lambda: failed.append(True)
+    sender.run()
+    assert failed == [True]
+    assert sender.client is None
+
+def test_sync_path(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"data")
+    sync_path(str(path))
+    if os.name == "posix":
+        sync_path(str(tmp_path), data_only=False)
+
+def test_rate_meter_window():
+    meter = RateMeter(window=3.0, smoothing=2.0)
+    for second in range(11):
+        meter.update(second * 100, now=second)
+    assert [now for now, _ in meter.samples] == [7, 8, 9, 10]
+    assert meter.current(10) == 100
+    assert meter.average() == 100
+    assert meter.done == 1000
+
+def test_rate_meter_decays_while_stalled():
+    meter = RateMeter(window=3.0, smoothing=2.0)
+    for second in range(5):
+        meter.update(second * 100, now=second)
+    assert meter.current(4) == 100
+    assert meter.current(7) == 50
+    assert meter.current(14) < meter.current(7)
+    assert meter.peak == 100
+
+def test_rate_meter_peak_ignores_a_short_window():
+    meter = RateMeter(window=4.0, smoothing=2.0)
+    meter.update(0, now=0)
+    meter.update(1000, now=1)
+    assert meter.peak == 0
+    meter.update(1200, now=2)
+    meter.update(1400, now=3)
+    assert meter.peak == 1200 / 2
+    meter.update(1500, now=6)
+    assert meter.peak == 1200 / 2
+
+def test_rate_meter_eta():
+    meter = RateMeter(window=3.0, smoothing=2.0)
+    assert meter.eta(1000) is None
+    meter.update(0, now=0)
+    meter.update(100, now=1)
+    assert meter.eta(1000) == 9
+    meter.update(500, now=3)
+    assert meter.smoothed == pytest.approx(100 + (1 - math.exp(-1)) * 100)
+    assert meter.eta(1000) == pytest.approx(500 / meter.smoothed)
+    assert meter.eta(100) == 0
+
+def test_metrics_merge():
+    total, first, second = Metrics(), Metrics(), Metrics()
+    first.add(bytes_sent=100, blocks=1)
+    first.gauge("tcp_rtt_seconds", 0.5)
+    second.add(bytes_sent=50)
+    second.gauge("tcp_rtt_seconds", 0.25)
+    total.merge(first)
+    total.merge(second)
+    assert total.counters == {"bytes_sent": 150, "blocks": 1}
+    assert total.gauges == {"tcp_rtt_seconds": 0.25}
+
+def test_metrics_prometheus():
+    metrics = Metrics()
+    metrics.add(bytes_sent=100)
+    metrics.gauge("tcp_snd_cwnd", 10)
+    assert metrics.prometheus(role="send", peer='a "b"\\c').splitlines() == [
+        "# TYPE phantomfile_bytes_sent_total counter",
+        'phantomfile_bytes_sent_total{peer="a \\"b\\"\\\\c",role="send"} 100',
+        "# TYPE phantomfile_tcp_snd_cwnd gauge",
+        'phantomfile_tcp_snd_cwnd{peer="a \\"b\\"\\\\c",role="send"} 10']
+
+def batch_of(folder, sizes):
+    folder.mkdir()
+    for number, size in enumerate(sizes):
+        (folder / "part{}.bin".format(number)).write_bytes(bytes(size))
+    return Batch.from_paths([str(folder)])
+
+@pytest.mark.parametrize("depth", [0, 2])
+def test_disk_queue_round_trip(tmp_path, depth):
+    batch = batch_of(tmp_path / "batch", [3000, 1, 5000])
+    data = os.urandom(batch.size)
+    written = []
+    with BatchFile(batch, 'r+b') as file, DiskQueue(file, depth, 1024, Metrics()) as disk:
+        for offset in range(0, batch.size, 1024):
+            buffer = disk.take()
+            view = memoryview(buffer)[:min(1024, batch.size - offset)]
+            view[:] = data[offset:offset + len(view)]
+            disk.write_at(buffer, view, offset, then=written.append)
+    assert sum(written) == batch.size
+    with BatchFile(batch, 'rb') as file, DiskQueue(file, depth, 1000, Metrics()) as disk:
+        assert b"".join(bytes(view) for view in disk.read_ahead(0, batch.size, 1000)) == data
+        assert len(disk.free) == max(depth + 1, 2)
+
+def test_disk_queue_skips_jobs_after_a_failure(tmp_path):
+    batch = batch_of(tmp_path / "batch", [10])
+    ran = []
+
+    def fail():
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        with BatchFile(batch, 'r+b') as file, DiskQueue(file, 2, 10, Metrics()) as disk:
+            disk.submit(fail)
+            disk.submit(ran.append, "commit")
+    assert ran == []
+
+def test_disk_queue_read_ahead_stops_at_a_short_file(tmp_path):
+    batch = batch_of(tmp_path / "batch", [5000])
+    os.truncate(batch.paths[0], 3000)
+    with BatchFile(batch, 'rb') as file, DiskQueue(file, 2, 1024, Metrics()) as disk:
+        with pytest.raises(EOFError):
+            for view in disk.read_ahead(0, batch.size, 1024):
+                pass
+        assert len(disk.free) == 3
+
+def test_mapped_file_crosses_windows(tmp_path):
+    window = mmap.ALLOCATIONGRANULARITY
+    batch = batch_of(tmp_path / "batch", [3 * window + 100, 10, window])
+    data = os.urandom(batch.size)
+    with MappedFile(batch, 'r+b', window=window) as file:
+        file.write_at(memoryview(data)[:window + 7], 0)
+        file.write_at(memoryview(data)[window + 7:], window + 7)
+    with MappedFile(batch, 'rb', window=window) as file:
+        view = memoryview(bytearray(batch.size - 50))
+        assert file.read_at(view, 50) == len(view)
+        assert view == data[50:]
+        slices = [bytes(part) for part in file.slices(0, batch.size, window // 2 + 1)]
+    assert b"".join(slices) == data
+    assert max(map(len, slices)) <= window // 2 + 1
+
+def test_mapped_file_refuses_a_shrunk_file(tmp_path):
+    batch = batch_of(tmp_path / "batch", [2 * mmap.ALLOCATIONGRANULARITY])
+    os.truncate(batch.paths[0], 100)
+    with MappedFile(batch, 'rb') as file:
+        with pytest.raises(EOFError):
+            file.read_at(memoryview(bytearray(200)), 0)
+
+def test_mapped_file_releases_views_on_close(tmp_path):
+    batch = batch_of(tmp_path / "batch", [mmap.ALLOCATIONGRANULARITY])
+    file = MappedFile(batch, 'rb')
+    part = next(file.parts(0, 10))
+    file.close()
+    with pytest.raises(ValueError):
+        bytes(part)